@@ -1,73 +1,152 @@
 import cv2
 import numpy as np
 from typing import Tuple, List
+import os
+import sys
 import time 
-from src.utils.utils import logger, send_alert, custom_json_deserializer
+import signal
+import threading
+from src.utils.utils import logger, send_alert
 
-from src.utils.video_utils import VideoUtils
-from src.utils.utils import custom_json_deserializer
+from src.utils.message_utils import Transaction, decode_transaction, \
+    to_transaction
 from src.utils.db_utils import DBUtils
+from src.utils.kafka_utils import WorkerPoolConsumer
+from src.utils.s3_utils import VideoSpool
+from src.utils.cache_utils import ResultCache, video_fingerprint
+from src.utils.idempotency_utils import IdempotencyGuard
+from src.utils.schedule_utils import VideoScheduler
+from src.utils import metrics
 from src.models.features import FeatureExtraction
+from src.models.identity import IdentityIndex
+from src.models.parallel import ProcessPoolFeatureExtraction
+from src.features import build_features
+from src.features.build_features import process_result
 
 from kafka import KafkaConsumer, TopicPartition
 from kafka.structs import OffsetAndMetadata
-from consts import KafkaConsts, Status, FRAME_EVERY_X_SECONDS, SENTRY_URL, S3_BASE_URL
+from consts import (KafkaConsts, ModelConsts, DownloadConsts, CacheConsts,
+                    IdempotencyConsts, ScheduleConsts, IdentityConsts, Status,
+                    SENTRY_URL, S3_BASE_URL, METRICS_PORT, READY_FILE,
+                    FRAME_EVERY_X_SECONDS)
 
 import sentry_sdk
 from sentry_sdk.integrations.logging import LoggingIntegration
 
 
-feature_extraction = FeatureExtraction()
+# models are loaded and warmed up in the background while the consumer
+# connects
+inference_pool = ModelConsts.INFERENCE_WORKERS > 0 \
+    and ModelConsts.DETECTION_MODE != 'batch'
+if inference_pool:
+    feature_extraction = ProcessPoolFeatureExtraction(
+        ModelConsts.INFERENCE_WORKERS,
+        threads_per_worker=ModelConsts.INFERENCE_THREADS, lazy=True)
+else:
+    feature_extraction = FeatureExtraction(lazy=True)
+worker_state = threading.local()
+# videos of queued messages are downloaded while the current one is analysed
+spool = VideoSpool(
+    DownloadConsts.SPOOL_DIR, DownloadConsts.SPOOL_MAX_BYTES,
+    connections=DownloadConsts.CONNECTIONS,
+    part_size=DownloadConsts.PART_SIZE,
+    prefetch_workers=DownloadConsts.PREFETCH_WORKERS
+) if DownloadConsts.SPOOL_DIR else None
+# results of videos already analysed by this model version, whatever their
+# geoChatId
+result_cache = ResultCache(
+    CacheConsts.RESULT_CACHE_DIR, ModelConsts.MODEL_VERSION,
+    CacheConsts.RESULT_CACHE_MAX_BYTES, CacheConsts.RESULT_CACHE_TTL
+) if CacheConsts.RESULT_CACHE_DIR else None
+# long videos are sampled less densely to fit their budget, short ones run
+# first
+scheduler = VideoScheduler(
+    ScheduleConsts.VIDEO_BUDGET,
+    decode_seconds_per_megapixel=ScheduleConsts.DECODE_SECONDS_PER_MEGAPIXEL,
+    seconds_per_sample=ScheduleConsts.SECONDS_PER_SAMPLE,
+    max_every_x_seconds=ScheduleConsts.MAX_EVERY_X_SECONDS,
+    probe_timeout=ScheduleConsts.PROBE_TIMEOUT
+) if ScheduleConsts.VIDEO_BUDGET > 0 else None
+# people already seen in the previous videos of each user
+identity_index = IdentityIndex(
+    IdentityConsts.INDEX_DIR, IdentityConsts.MAX_PER_USER,
+    IdentityConsts.TOLERANCE) if IdentityConsts.INDEX_DIR else None
+# replayed geoChatIds are dropped without asking the database when possible
+idempotency = IdempotencyGuard(
+    DBUtils.check_if_already_processed, IdempotencyConsts.RECENT_SIZE,
+    IdempotencyConsts.RECENT_TTL, IdempotencyConsts.BLOOM_CAPACITY,
+    IdempotencyConsts.BLOOM_ERROR_RATE)
+
+def get_feature_extraction() -> FeatureExtraction:
+    # every worker thread owns its own models, the main thread and the process
+    # pool are shared
+    if inference_pool or threading.current_thread() is threading.main_thread():
+        return feature_extraction
+    if not hasattr(worker_state, 'feature_extraction'):
+        worker_state.feature_extraction = FeatureExtraction(lazy=True)
+    return worker_state.feature_extraction
+
+def warm_idempotency() -> None:
+    t1 = time.time()
+    geoChatIds = DBUtils.get_processed_geoChatIds()
+    idempotency.warm(geoChatIds)
+    logger.info(f"Bloom filter warmed with {len(geoChatIds)} geoChatIds in "
+                f"{round(time.time()-t1, 1)} seconds")
+
+def write_ready_file() -> None:
+    # readiness signal for the container probe
+    with open(READY_FILE, 'w') as f:
+        f.write(str(time.time()))
+
+def warm_up() -> None:
+    t1 = time.time()
+    feature_extraction.warm_up()
+    write_ready_file()
+    logger.info(f"Models ready in {round(time.time()-t1, 1)} seconds")
+
+def warm_up_worker() -> None:
+    # runs on every worker thread of the pool before its first message
+    t1 = time.time()
+    get_feature_extraction().warm_up()
+    logger.info(f"Worker models ready in {round(time.time()-t1, 1)} seconds")
+
+def workers_ready() -> None:
+    write_ready_file()
+    logger.info("Models of every worker ready")
 
 def get_s3_url(file_name):
     return S3_BASE_URL + file_name
 
-def get_face_features(url: str) -> Tuple[np.ndarray, np.ndarray]:
-    merged_frames  = VideoUtils(url).merged_frames
-    has_faces, info_clusters = feature_extraction.get_features(merged_frames)
-    return has_faces, info_clusters
-
-def thresh_skintone(score):
-    if score == None:
-         skin_colour = None
-    elif score <= 2:
-        skin_colour = 'dusky'
-    elif score >= 4.5:
-        skin_colour = 'fair'
-    elif score >2 and score < 4.5:
-        skin_colour = 'wheatish'
-    else: 
-        skin_colour = None
-    return skin_colour
-
-def process_result(result):
-    people = []
-    for i in range(len(result)):
-        person = {}
-        person['gender'] = result[i]['gender']
-        person['age'] = result[i]['age']
-        skin_tone = thresh_skintone(result[i]['skin_tone'])
-        if skin_tone == None:
-            person['skin_tone_score'] = None
-            person['skin_tone'] = None
-        else:
-            person['skin_tone_score'] = result[i]['skin_tone']
-            person['skin_tone'] = skin_tone
-        person['duration'] = len(result[i]['locations']) * FRAME_EVERY_X_SECONDS
-        people.append(person)
-    return people
-
-def process_transaction(transaction_data: dict, isRecovery: bool = False) -> None:
+def get_face_features(
+        url: str, userId: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    identities = identity_index.for_user(userId) \
+        if identity_index is not None and userId is not None else None
+    return build_features.get_face_features(
+        url, get_feature_extraction(), spool, scheduler, identities)
+
+def process_transaction(transaction_data, isRecovery: bool = False) -> None:
     """
-    :param dict transaction:
+    :param Transaction transaction: or the dict of its data
     :param bool isRecovery:
     :return:
     """
+    transaction = transaction_data \
+        if isinstance(transaction_data, Transaction) \
+        else to_transaction(transaction_data)
+    if transaction is None:
+        logger.error(f"Invalid transaction: {transaction_data}")
+        return
+
+    with metrics.track_video(transaction.geoChatId):
+        run_transaction(transaction, isRecovery)
+        # the offset is committed once the results are written, not only queued
+        DBUtils.wait_for_writes(transaction.geoChatId)
+        logger.info(f"Finished geoChatId {transaction.geoChatId}")
 
-    trailId = transaction_data.get("trailId", None)
-    geoChatId = transaction_data.get("geoChatId", None)
-    geoChatVideo = transaction_data.get("geoChatVideo", None)
-    userId = transaction_data.get("userId", None)
+def run_transaction(
+        transaction: Transaction, isRecovery: bool = False) -> None:
+
+    trailId, geoChatId, geoChatVideo, userId = transaction
     
     if userId is None:
         userId = DBUtils.get_userId(trailId)
@@ -78,11 +157,12 @@ def process_transaction(transaction_data: dict, isRecovery: bool = False) -> Non
 
     elif trailId is None or geoChatId is None or geoChatVideo is None:
         logger.error(
-            f"Missing trailId, userId, geoChatId or geoChatVideo in transaction: {transaction_data}")
+            "Missing trailId, userId, geoChatId or geoChatVideo in "
+            f"transaction: {transaction}")
         return
 
     if isRecovery == False:
-        isAlreadyProcessed = DBUtils.check_if_already_processed(geoChatId)
+        isAlreadyProcessed = not idempotency.claim(geoChatId)
 
         if isAlreadyProcessed:
             logger.info(f"GeoChatId {geoChatId} already processed")
@@ -92,22 +172,136 @@ def process_transaction(transaction_data: dict, isRecovery: bool = False) -> Non
     
     file_name = geoChatVideo.split("/")[-1]
     s3_url = get_s3_url(file_name)
-    
+
     try:
-        has_faces, info_clusters = get_face_features(s3_url)
+        has_faces, people = cached_or_compute(s3_url, userId)
     except Exception as e:
         send_alert(f"Error in processing video: {s3_url} :: {e}")
         logger.exception(f"Error in processing video: {s3_url}")
         DBUtils.update_status(Status.FAILED, trailId, userId, geoChatId)
     else:
-        if has_faces:
-            people = process_result(info_clusters)
-            people = sorted(people, key = lambda i: i['duration'], reverse=True)
-        else:
-            people = []
         DBUtils.update_trail_info(
             geoChatId, Status.SUCCESS, has_faces, people)
 
+def cached_or_compute(s3_url: str, userId: int = None) -> Tuple[bool, list]:
+    """
+    has_faces and the people of a video, reused from the result cache when
+    possible
+    """
+    # blended with the people of the user's previous videos, results are not
+    # reusable
+    identities_applied = identity_index is not None and userId is not None
+    fingerprint = video_fingerprint(s3_url) \
+        if result_cache is not None and not identities_applied else None
+    cached = result_cache.get(fingerprint) if fingerprint is not None else None
+    if cached is not None:
+        logger.info(f"Reusing cached result of {s3_url}")
+        return cached['has_faces'], cached['people']
+
+    has_faces, info_clusters = get_face_features(s3_url, userId)
+    if has_faces:
+        people = process_result(info_clusters)
+        people = sorted(people, key = lambda i: i['duration'], reverse=True)
+    else:
+        people = []
+    if fingerprint is not None:
+        result_cache.put(
+            fingerprint, {'has_faces': bool(has_faces), 'people': people})
+    return has_faces, people
+
+def get_transaction(message) -> Transaction:
+    # decoded by the consumer, None for any other event than serve-ready
+    return message.value
+
+def get_message_url(message) -> str:
+    transaction = get_transaction(message)
+    if transaction is None or transaction.geoChatVideo is None:
+        return None
+    return get_s3_url(transaction.geoChatVideo.split("/")[-1])
+
+def prefetch_message(message) -> None:
+    url = get_message_url(message)
+    if url is not None:
+        spool.prefetch(url)
+
+def message_cost(message) -> float:
+    url = get_message_url(message)
+    if url is None:
+        return 0
+    return scheduler.cost(url, FRAME_EVERY_X_SECONDS)
+
+def handle_message(message) -> None:
+    transaction = get_transaction(message)
+    if transaction is None:
+        return
+    pt1 = time.time()
+    try:
+        process_transaction(transaction)
+    finally:
+        if spool is not None and get_message_url(message) is not None:
+            # also frees the videos of messages skipped before decoding
+            spool.release(get_message_url(message))
+    pt2 = time.time()
+    logger.info(
+        f"Time taken in process transaction = {round(pt2-pt1)} seconds "
+        f"({message.partition} ::: {message.offset})")
+
+
+def run_pool(consumer: KafkaConsumer, warm_workers: bool) -> None:
+    pool = WorkerPoolConsumer(
+        consumer, handle_message, KafkaConsts.WORKER_COUNT,
+        max_in_flight=KafkaConsts.MAX_IN_FLIGHT,
+        prefetch=prefetch_message if spool is not None else None,
+        priority=message_cost if scheduler is not None else None,
+        initializer=warm_up_worker if warm_workers else None,
+        ready=workers_ready)
+    consumer.subscribe(
+        [KafkaConsts.CONSUMER_TRANSACTIONS_TOPIC], listener=pool)
+    # a pod stop finishes the running videos and writes their results
+    signal.signal(signal.SIGTERM, lambda signum, frame: pool.request_stop())
+    pool.run()
+
+def run_consumer(consumer: KafkaConsumer) -> None:
+    consumer.subscribe([KafkaConsts.CONSUMER_TRANSACTIONS_TOPIC])
+    stopping = threading.Event()
+    processing = threading.Event()
+
+    def stop(signum, frame):
+        # a video being processed is finished and committed first
+        stopping.set()
+        if not processing.is_set():
+            sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    for message in consumer:
+        logger.info("%s : %d ::: %d:", message.topic, message.partition,
+                    message.offset)
+
+        transaction = get_transaction(message)
+        if transaction is None:
+            continue
+
+        processing.set()
+        pt1 = time.time()
+        process_transaction(transaction)
+        pt2 = time.time()
+        
+        tc1 = time.time()
+        tp = TopicPartition(
+            KafkaConsts.CONSUMER_TRANSACTIONS_TOPIC,  message.partition)
+        consumer.commit({
+            tp: OffsetAndMetadata(message.offset+1, None)
+        })
+        tc2 = time.time()
+
+        logger.info(
+            f"Time taken in process transaction = {round(pt2-pt1)} seconds")
+        logger.info(
+            f"Time taken in committing topics   = {round(tc2-tc1)} seconds")
+        processing.clear()
+        if stopping.is_set():
+            break
+
 
 if __name__ == '__main__':
     if SENTRY_URL is not None:
@@ -115,47 +309,37 @@ if __name__ == '__main__':
 
     print("Conencting at - ",KafkaConsts.KAFKA_BROKER_URL)
     print("Consumer GroupId - ", KafkaConsts.GROUP_ID)
+    if METRICS_PORT:
+        metrics.start_metrics_server(METRICS_PORT)
+    if os.path.exists(READY_FILE):
+        os.remove(READY_FILE)
+    if spool is not None:
+        spool.remove_partial_downloads()
+    # a single worker still runs through the pool to prefetch the next videos
+    pool_mode = KafkaConsts.WORKER_COUNT > 1 or spool is not None
+    # pool workers own their models, unless they share the inference processes
+    warm_workers = pool_mode and not inference_pool
+    if not warm_workers:
+        threading.Thread(target=warm_up, daemon=True).start()
+    if IdempotencyConsts.BLOOM_CAPACITY > 0:
+        threading.Thread(target=warm_idempotency, daemon=True).start()
     consumer = KafkaConsumer(
-        KafkaConsts.CONSUMER_TRANSACTIONS_TOPIC,
         group_id=KafkaConsts.GROUP_ID,
         bootstrap_servers=KafkaConsts.KAFKA_BROKER_URL,
-        value_deserializer=custom_json_deserializer,
+        value_deserializer=decode_transaction,
         auto_offset_reset='latest',
-        max_poll_interval_ms=5*60*1000,
-        max_poll_records=1,
+        # the worker pool commits completed offsets itself
+        enable_auto_commit=not pool_mode,
+        max_poll_interval_ms=KafkaConsts.MAX_POLL_INTERVAL_MS,
+        max_poll_records=KafkaConsts.MAX_POLL_RECORDS if pool_mode else 1,
         session_timeout_ms=60*1000,
         heartbeat_interval_ms=2000
     )
 
-    for message in consumer:
-        print("-----------------------------------")
-        print("%s : %d ::: %d:" %
-              (message.topic, message.partition, message.offset))
-        print(message.value)
-       
-        if message.value is None:
-            continue
-        else:
-            _val = str(message.value)
-            transaction: dict = eval(_val)
-        
-        if transaction.get('type', None) == 'serve-ready':
-            pt1 = time.time()
-            process_transaction(transaction["data"])
-            pt2 = time.time()
-        else:
-            continue
-            
-        print("consumer offsetting...")
-        tc1 = time.time()
-        tp = TopicPartition(
-            KafkaConsts.CONSUMER_TRANSACTIONS_TOPIC,  message.partition)
-        consumer.commit({
-            tp: OffsetAndMetadata(message.offset+1, None)
-        })
-        tc2 = time.time()
-
-        print(f"Time taken in process transaction = {round(pt2-pt1)} seconds")
-        print(f"Time taken in committing topics   = {round(tc2-tc1)} seconds")
+    if pool_mode:
+        run_pool(consumer, warm_workers)
+    else:
+        run_consumer(consumer)
 
-    
+    DBUtils.flush_writes()
+    logger.info("Stopped")
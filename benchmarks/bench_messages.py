@@ -0,0 +1,64 @@
+"""
+Benchmark of decoding consumer messages into transactions.
+
+    python -m benchmarks.bench_messages
+
+Compares the previous decoding (JSON parse, then str() and eval of the dict)
+with `decode_transaction` over the raw message values of a sample file, one
+value per line (`--samples`, benchmarks/samples/messages.jsonl by default),
+repeated to `--messages` messages.
+"""
+import argparse
+import json
+import os
+import time
+
+from src.utils.message_utils import decode_transaction, loads
+
+SAMPLES = os.path.join(os.path.dirname(__file__), 'samples', 'messages.jsonl')
+
+
+def legacy_decode(value: bytes):
+    if value is None:
+        return None
+    transaction = eval(str(json.loads(value.decode('utf-8'))))
+    if transaction.get('type', None) == 'serve-ready':
+        return transaction
+    return None
+
+
+def bench(decode, values: list) -> dict:
+    t1 = time.perf_counter()
+    transactions = [decode(value) for value in values]
+    seconds = time.perf_counter() - t1
+    return {'seconds': round(seconds, 4),
+            'messages_per_second': round(len(values) / seconds),
+            'transactions': sum(transaction is not None
+                                for transaction in transactions)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--samples', default=SAMPLES, help='raw message values, one per line')
+    parser.add_argument('--messages', type=int, default=200000)
+    args = parser.parse_args()
+
+    with open(args.samples, 'rb') as f:
+        samples = [line.rstrip(b'\n') for line in f if line.strip()]
+    values = (samples * (args.messages // len(samples) + 1))[:args.messages]
+    print(f"{len(values)} messages from {len(samples)} samples, "
+          f"parser: {loads.__module__}")
+    for name, decode in [
+            ('legacy', legacy_decode),
+            ('decode_transaction', decode_transaction)]:
+        result = bench(decode, values)
+        print(f"    {name:<20} {result['seconds']:>9.4f}s "
+              f"{result['messages_per_second']:>10}/s "
+              f"{result['transactions']:>8} transactions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""
+Per-stage benchmark of the video pipeline on synthetic videos.
+
+    python -m benchmarks.bench_pipeline --models stub --output bench.jsonl
+
+Each stage is timed on its own and reports its throughput and peak traced
+memory; results are tagged with the current git commit so runs can be
+compared across commits.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from src.utils.video_utils import VideoUtils, MosaicBuilder
+from src.models.features import FeatureExtraction
+from src.features.build_features import process_result
+from benchmarks.stubs import StubFaceAnalysis, StubFaceEncoder
+
+# (seconds, width, height, fps)
+VIDEO_CONFIGS = [
+    (30, 640, 360, 25),
+    (120, 1280, 720, 30),
+    (300, 1920, 1080, 30),
+]
+
+
+def make_video(
+        path: str, seconds: int, width: int, height: int, fps: int) -> str:
+    """
+    Write a synthetic video with moving shapes so frames are not identical
+    """
+    writer = cv2.VideoWriter(
+        path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    for i in range(seconds * fps):
+        frame = np.full((height, width, 3), (i * 3) % 255, dtype=np.uint8)
+        x = (i * 7) % max(width - 100, 1)
+        cv2.rectangle(
+            frame, (x, height // 4), (x + 100, height // 4 + 100),
+            (40, 120, 220), -1)
+        cv2.putText(
+            frame, str(i), (20, height - 20), cv2.FONT_HERSHEY_SIMPLEX, 1,
+            (255, 255, 255), 2)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def measure(fn):
+    tracemalloc.start()
+    t1 = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - t1
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def get_feature_extraction(models: str) -> FeatureExtraction:
+    if models == 'real':
+        return FeatureExtraction()
+    face_analysis = StubFaceAnalysis()
+    return FeatureExtraction(dual_detector=False, face_analysis=face_analysis,
+                             face_encoder=StubFaceEncoder(face_analysis))
+
+
+def bench_video(path: str, feature_extraction: FeatureExtraction) -> dict:
+    stages = {}
+
+    def record(name, fn, items):
+        result, seconds, peak = measure(fn)
+        per_second = round(items(result) / seconds, 2) if seconds > 0 \
+            else None
+        stages[name] = {'seconds': round(seconds, 4), 'items': items(result),
+                        'items_per_second': per_second,
+                        'peak_traced_mb': round(peak / 2**20, 2)}
+        return result
+
+    video = VideoUtils(path, streaming=True)
+    frames = record(
+        'decode', lambda: [frame for _, frame in video.iterVideoFrames()], len)
+
+    def merge():
+        builder = MosaicBuilder(
+            video.col_count, video.row_count, downscale=True)
+        merged_frames = [m for m in map(builder.add, frames) if m is not None]
+        last = builder.flush()
+        return merged_frames + ([last] if last is not None else [])
+    merged_frames = record('merge_frames', merge, len)
+
+    def detect():
+        detections = []
+        for merged_frame in merged_frames:
+            faces_details, locations = feature_extraction.bbox_to_locations(
+                feature_extraction.face_analysis.get(merged_frame),
+                merged_frame.shape)
+            detections.append((merged_frame, faces_details, locations))
+        return detections
+    detections = record(
+        'detection', detect, lambda d: sum(len(x[2]) for x in d))
+
+    def encode():
+        faces_details, locations, encodings, skin_tones = [], [], [], []
+        for merged_frame, _faces_details, _locations in detections:
+            faces_details += _faces_details
+            locations += _locations
+            encodings += feature_extraction.face_encoder.face_encodings(
+                merged_frame, known_face_locations=_locations)
+            skin_tones += feature_extraction.score_skin_tones(
+                merged_frame, _locations)
+        return feature_extraction.merge_info(
+            faces_details, locations, encodings, skin_tones)
+    merged_info = record('encoding', encode, lambda m: len(m['locations']))
+
+    clusters = record(
+        'cluster_faces',
+        lambda: feature_extraction.cluster_faces(merged_info['encodings']),
+        lambda _: len(merged_info['encodings']))
+    info_clusters = record('aggregate_cluster_info',
+                           lambda: feature_extraction.aggregate_cluster_info(
+                               clusters, merged_info),
+                           lambda _: sum(len(c) for c in clusters))
+    record('process_result', lambda: process_result(info_clusters), len)
+
+    total = sum(stage['seconds'] for stage in stages.values())
+    return {'stages': stages, 'frames': len(frames),
+            'faces': len(merged_info['locations']),
+            'clusters': len(clusters), 'total_seconds': round(total, 4),
+            'videos_per_minute': round(60 / total, 2) if total > 0 else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', choices=['stub', 'real'], default='stub')
+    parser.add_argument(
+        '--videos', nargs='*',
+        help='existing videos to benchmark instead of synthetic ones')
+    parser.add_argument(
+        '--max-seconds', type=int, default=None,
+        help='cap the length of synthetic videos')
+    parser.add_argument(
+        '--output', help='append results as JSON lines to this file')
+    args = parser.parse_args()
+
+    feature_extraction = get_feature_extraction(args.models)
+    commit = git_commit()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        videos = [(path, {}) for path in (args.videos or [])]
+        if not videos:
+            for seconds, width, height, fps in VIDEO_CONFIGS:
+                seconds = min(seconds, args.max_seconds or seconds)
+                path = os.path.join(
+                    tmp_dir, f"{seconds}s_{width}x{height}_{fps}fps.mp4")
+                config = {'seconds': seconds, 'width': width,
+                          'height': height, 'fps': fps}
+                videos.append(
+                    (make_video(path, seconds, width, height, fps), config))
+
+        for path, config in videos:
+            result = bench_video(path, feature_extraction)
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result.update({'commit': commit, 'models': args.models,
+                           'video': os.path.basename(path), 'config': config,
+                           'max_rss_mb': round(max_rss / 1024, 1)})
+            print(f"{result['video']}: {result['frames']} frames, "
+                  f"{result['faces']} faces, {result['clusters']} clusters, "
+                  f"{result['videos_per_minute']} videos/min")
+            for name, stage in result['stages'].items():
+                print(f"    {name:<24} {stage['seconds']:>9.4f}s "
+                      f"{str(stage['items_per_second']):>12}/s "
+                      f"{stage['peak_traced_mb']:>9.2f}MB")
+            if args.output:
+                with open(args.output, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
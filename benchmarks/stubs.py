@@ -0,0 +1,70 @@
+import numpy as np
+from typing import List, Tuple
+
+
+class StubFace(dict):
+    """
+    Dict with attribute access, like insightface's Face
+    """
+
+    def __getattr__(self, name):
+        return self.get(name)
+
+
+class StubFaceAnalysis:
+    """
+    Stand-in for insightface's FaceAnalysis: one face in the middle of every
+    `cell_size` cell of the image, no models to download
+    """
+
+    def __init__(self, cell_size: Tuple[int, int] = (100, 100),
+                 face_ratio: float = 0.4) -> None:
+        self.cell_size = cell_size
+        self.face_ratio = face_ratio
+        self.models = {'genderage': self}
+
+    def boxes(self, img: np.ndarray) -> List[Tuple[int, int, int, int]]:
+        cell_h, cell_w = self.cell_size
+        half_h = int(cell_h * self.face_ratio / 2)
+        half_w = int(cell_w * self.face_ratio / 2)
+        boxes = []
+        for cy in range(cell_h // 2, img.shape[0] - half_h, cell_h):
+            for cx in range(cell_w // 2, img.shape[1] - half_w, cell_w):
+                boxes.append(
+                    (cx - half_w, cy - half_h, cx + half_w, cy + half_h))
+        return boxes
+
+    def get(self, img: np.ndarray, face: StubFace = None):
+        if face is not None:
+            # genderage model interface
+            face['gender'], face['age'] = 1, 30
+            return face['gender'], face['age']
+        return [StubFace(bbox=np.array(box, dtype=np.float32), det_score=0.9,
+                         gender=1, age=30) for box in self.boxes(img)]
+
+
+class StubFaceEncoder:
+    """
+    Stand-in for the face_recognition module: the same boxes as
+    StubFaceAnalysis and encodings drawn around `identities` fixed centers
+    """
+
+    def __init__(self, face_analysis: StubFaceAnalysis, identities: int = 3,
+                 seed: int = 0) -> None:
+        self.face_analysis = face_analysis
+        self.rng = np.random.RandomState(seed)
+        self.centers = self.rng.normal(scale=0.1, size=(identities, 128))
+
+    def face_locations(
+            self, img: np.ndarray) -> List[Tuple[int, int, int, int]]:
+        return [(y1, x2, y2, x1)
+                for x1, y1, x2, y2 in self.face_analysis.boxes(img)]
+
+    def face_encodings(self, img: np.ndarray,
+                       known_face_locations=None) -> List[np.ndarray]:
+        if known_face_locations is None:
+            known_face_locations = self.face_locations(img)
+        identities = self.rng.randint(
+            len(self.centers), size=len(known_face_locations))
+        return [self.centers[i] + self.rng.normal(scale=0.02, size=128)
+                for i in identities]
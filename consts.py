@@ -9,16 +9,114 @@ load_dotenv(dotenv_path=dotenv_path)
 SENTRY_URL= os.environ.get("SENTRY_URL")
 SLACK_WEBHOOK = os.environ.get("SLACK_WEBHOOK")
 INSIGHTFACE_MODEL_URL = os.environ.get("INSIGHTFACE_MODEL_URL")
-FRAME_EVERY_X_SECONDS = int(os.environ.get("FRAME_EVERY_X_SECONDS", 1))
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR") or "~/.insightface/cache"
+# written once the models are warmed up
+READY_FILE = os.environ.get("READY_FILE") or "/tmp/ready"
+FRAME_EVERY_X_SECONDS = int(os.environ.get("FRAME_EVERY_X_SECONDS") or 1)
+# sampled frames whose 64-bit hash differs from the last kept frame in at most
+# this many bits are skipped, < 0 disables
+FRAME_DEDUP_DISTANCE = int(os.environ.get("FRAME_DEDUP_DISTANCE") or -1)
+# probe one frame every COARSE_EVERY_X_SECONDS first, then only sample around
+# the frames showing faces
+ADAPTIVE_SAMPLING = os.environ.get("ADAPTIVE_SAMPLING", "0") == "1"
+COARSE_EVERY_X_SECONDS = int(os.environ.get("COARSE_EVERY_X_SECONDS") or 10)
+# seconds of decoding per video, 0 disables
+VIDEO_TIME_BUDGET = int(os.environ.get("VIDEO_TIME_BUDGET") or 0)
 S3_BASE_URL = os.environ.get("S3_BASE_URL")
+# 0 disables the /metrics endpoint
+METRICS_PORT = int(os.environ.get("METRICS_PORT") or 8000)
 
 class MySQLConsts(ABC):
     LOG_TABLE = os.environ.get("LOG_TABLE")
+    # pooled connections, the legacy MySQL module is used when MYSQL_HOST is
+    # unset
+    HOST = os.environ.get("MYSQL_HOST")
+    PORT = int(os.environ.get("MYSQL_PORT") or 3306)
+    USER = os.environ.get("MYSQL_USER")
+    PASSWORD = os.environ.get("MYSQL_PASSWORD")
+    DATABASE = os.environ.get("MYSQL_DATABASE")
+    POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE") or 4)
+    # queue status and result writes and flush them in multi-row statements
+    WRITE_BEHIND = os.environ.get("MYSQL_WRITE_BEHIND", "0") == "1"
+    WRITE_BATCH_SIZE = int(os.environ.get("MYSQL_WRITE_BATCH_SIZE") or 50)
+    WRITE_FLUSH_SECONDS = float(
+        os.environ.get("MYSQL_WRITE_FLUSH_SECONDS") or 1)
 
 class KafkaConsts(ABC):
     GROUP_ID = os.environ.get("GROUP_ID")
     KAFKA_BROKER_URL = str(os.environ.get("KAFKA_BROKER_URL"))
     CONSUMER_TRANSACTIONS_TOPIC = str(os.environ.get("CONSUMER_TRANSACTIONS_TOPIC"))
+    # > 1 enables the worker pool consumer
+    WORKER_COUNT = int(os.environ.get("WORKER_COUNT") or 1)
+    MAX_POLL_RECORDS = int(os.environ.get("MAX_POLL_RECORDS") or 10)
+    # defaults to 2 * WORKER_COUNT
+    MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT") or 0) or None
+    MAX_POLL_INTERVAL_MS = 5*60*1000
+
+class DownloadConsts(ABC):
+    # videos are decoded straight from S3 when unset
+    SPOOL_DIR = os.environ.get("SPOOL_DIR")
+    SPOOL_MAX_BYTES = int(os.environ.get("SPOOL_MAX_BYTES") or 4*2**30)
+    # parallel range requests per video
+    CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS") or 4)
+    PART_SIZE = int(os.environ.get("DOWNLOAD_PART_SIZE") or 8*2**20)
+    # videos downloaded ahead at once
+    PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS") or 2)
+
+class CacheConsts(ABC):
+    # results are never reused when unset
+    RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR")
+    RESULT_CACHE_MAX_BYTES = int(
+        os.environ.get("RESULT_CACHE_MAX_BYTES") or 512*2**20)
+    # seconds
+    RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL") or 30*24*60*60)
+
+class ScheduleConsts(ABC):
+    # > 0 lowers the sampling of videos estimated to take longer than this many
+    # seconds, and runs the shortest queued videos first in the worker pool
+    VIDEO_BUDGET = float(os.environ.get("SCHEDULE_VIDEO_BUDGET") or 0)
+    # per decoded frame
+    DECODE_SECONDS_PER_MEGAPIXEL = float(
+        os.environ.get("SCHEDULE_DECODE_SECONDS_PER_MEGAPIXEL") or 0.002)
+    # detection and encoding per sampled frame
+    SECONDS_PER_SAMPLE = float(
+        os.environ.get("SCHEDULE_SECONDS_PER_SAMPLE") or 0.05)
+    MAX_EVERY_X_SECONDS = float(
+        os.environ.get("SCHEDULE_MAX_EVERY_X_SECONDS") or 30)
+    # seconds to read the header of a video, its cost is the budget after
+    PROBE_TIMEOUT = float(os.environ.get("SCHEDULE_PROBE_TIMEOUT") or 5)
+
+class IdentityConsts(ABC):
+    # unset disables the per user identity index, set bypasses the result cache
+    INDEX_DIR = os.environ.get("IDENTITY_INDEX_DIR")
+    MAX_PER_USER = int(os.environ.get("IDENTITY_MAX_PER_USER") or 32)
+    # centroid distance of the same person
+    TOLERANCE = float(os.environ.get("IDENTITY_TOLERANCE") or 0.5)
+    # faces averaged for known people
+    KNOWN_SKIN_TONE_SAMPLES = int(
+        os.environ.get("IDENTITY_KNOWN_SKIN_TONE_SAMPLES") or 3)
+
+class AlertConsts(ABC):
+    # alerts waiting to be sent, newer ones are dropped
+    QUEUE_SIZE = int(os.environ.get("ALERT_QUEUE_SIZE") or 1000)
+    RATE_PER_MINUTE = float(os.environ.get("ALERT_RATE_PER_MINUTE") or 10)
+    # repeats of an alert within it go to the digest
+    DEDUP_SECONDS = int(os.environ.get("ALERT_DEDUP_SECONDS") or 10*60)
+    DIGEST_SECONDS = int(os.environ.get("ALERT_DIGEST_SECONDS") or 5*60)
+    TIMEOUT = float(os.environ.get("ALERT_TIMEOUT") or 5)
+    # log records waiting to be written, newer ones are dropped
+    LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE") or 10000)
+
+class IdempotencyConsts(ABC):
+    # geoChatIds remembered in process
+    RECENT_SIZE = int(os.environ.get("IDEMPOTENCY_RECENT_SIZE") or 100000)
+    # seconds
+    RECENT_TTL = int(os.environ.get("IDEMPOTENCY_RECENT_TTL") or 24*60*60)
+    # > 0 warms a bloom filter of processed geoChatIds from the log table at
+    # startup
+    BLOOM_CAPACITY = int(os.environ.get("IDEMPOTENCY_BLOOM_CAPACITY") or 0)
+    BLOOM_ERROR_RATE = float(
+        os.environ.get("IDEMPOTENCY_BLOOM_ERROR_RATE") or 1e-6)
 
 class Status(ABC):
     PICKED = "PICKED"
@@ -27,4 +125,25 @@ class Status(ABC):
 
 class ModelConsts(ABC):
     MODEL_VERSION = "1.0.0"
+    # run dlib's HOG detector next to insightface and pair their faces (legacy)
+    DUAL_DETECTOR = os.environ.get("DUAL_DETECTOR", "0") == "1"
+    # average skin tone over at most this many faces per cluster (0 averages
+    # every face)
+    SKIN_TONE_SAMPLES = int(os.environ.get("SKIN_TONE_SAMPLES") or 0)
+    # 'mosaic' detects on merged frames, 'batch' on batches of sampled frames
+    DETECTION_MODE = os.environ.get("DETECTION_MODE") or "mosaic"
+    DET_BATCH_SIZE = int(os.environ.get("DET_BATCH_SIZE") or 8)
+    DET_INPUT_SIZE = tuple(int(x) for x in (
+        os.environ.get("DET_INPUT_SIZE") or "640,640").split(","))
+    # link faces across sampled frames and only encode a few faces of every
+    # track
+    TRACK_FACES = os.environ.get("TRACK_FACES", "0") == "1"
+    # entries per track
+    TRACK_SAMPLES = int(os.environ.get("TRACK_SAMPLES") or 3)
+    # faces of a track between two entries
+    TRACK_SAMPLE_EVERY = int(os.environ.get("TRACK_SAMPLE_EVERY") or 10)
+    # > 0 runs mosaic detection and encoding on a pool of this many processes
+    INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS") or 0)
+    # defaults to cores / INFERENCE_WORKERS
+    INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS") or 0) or None
 
@@ -1,30 +1,166 @@
 # -*- coding: utf-8 -*-
 import click
+import json
 import logging
+import multiprocessing
+import os
+import sys
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
 
+# consts and src are imported from the repository root when run as a script
+project_dir = Path(__file__).resolve().parents[2]
+if str(project_dir) not in sys.path:
+    sys.path.insert(0, str(project_dir))
+
+# find .env automagically by walking up directories until it's found, then
+# load up the .env entries as environment variables, consts read them on import
+load_dotenv(find_dotenv())
+
+from consts import ModelConsts  # noqa: E402
+from src.utils.utils import to_json  # noqa: E402
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.m4v', '.webm', '.mkv', '.avi')
+
+# state of a pool worker process
+feature_extraction = None
+
+
+def list_videos(input_filepath: str, extensions=VIDEO_EXTENSIONS) -> list:
+    """
+    Video files found under a directory, or the paths/URLs listed one per line
+    in a manifest
+    """
+    if os.path.isdir(input_filepath):
+        return sorted(str(path) for path in Path(input_filepath).rglob('*')
+                      if path.suffix.lower() in extensions)
+    with open(input_filepath) as f:
+        lines = (line.strip() for line in f)
+        return [line for line in lines if line and not line.startswith('#')]
+
+
+def read_done(records_filepath: str, model_version: str) -> set:
+    """
+    Videos already processed successfully with `model_version`, a torn last
+    line is ignored
+    """
+    done = set()
+    if not os.path.exists(records_filepath):
+        return done
+    with open(records_filepath) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('model_version') == model_version \
+                    and 'error' not in record:
+                done.add(record['video'])
+    return done
+
+
+def init_worker() -> None:
+    global feature_extraction
+    from src.models.features import FeatureExtraction
+    feature_extraction = FeatureExtraction()
+
+
+def process_video(video: str) -> dict:
+    from src.features.build_features import get_face_features, process_result
+
+    record = {'video': video, 'model_version': ModelConsts.MODEL_VERSION}
+    try:
+        has_faces, info_clusters = get_face_features(video, feature_extraction)
+    except Exception as e:
+        logging.getLogger(__name__).exception(
+            f"Error in processing video: {video}")
+        record['error'] = str(e)
+        return record
+    if has_faces:
+        people = process_result(info_clusters)
+        people = sorted(people, key=lambda i: i['duration'], reverse=True)
+    else:
+        people = []
+    record.update({'has_faces': bool(has_faces), 'people': people})
+    return record
+
+
+def write_parquet(records_filepath: str, output_filepath: str) -> None:
+    try:
+        import pandas as pd
+    except ImportError:
+        raise click.ClickException(
+            'Parquet output needs pandas and pyarrow installed')
+    df = pd.read_json(records_filepath, lines=True)
+    # keep the last attempt of every video
+    df = df.drop_duplicates('video', keep='last')
+    df['people'] = df['people'].apply(
+        lambda people: json.dumps(people) if isinstance(people, list)
+        else None)
+    df.to_parquet(output_filepath, index=False)
+
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
-def main(input_filepath, output_filepath):
-    """ Runs data processing scripts to turn raw data from (../raw) into
-        cleaned data ready to be analyzed (saved in ../processed).
+@click.option(
+    '--workers', default=1, show_default=True,
+    help='Processes, each with its own models')
+@click.option('--output-format', type=click.Choice(['jsonl', 'parquet']),
+              default=None,
+              help='Defaults to the extension of OUTPUT_FILEPATH')
+def main(input_filepath, output_filepath, workers, output_format):
+    """ Runs the face features of every video in INPUT_FILEPATH, a directory
+        or a manifest of paths/URLs, and writes one record per video to
+        OUTPUT_FILEPATH. Results are appended as they complete, rerunning
+        resumes with the videos not yet processed by the current model version.
+
+        python src/data/make_dataset.py INPUT_FILEPATH OUTPUT_FILEPATH
+        python -m src.data.make_dataset INPUT_FILEPATH OUTPUT_FILEPATH
     """
     logger = logging.getLogger(__name__)
-    logger.info('making final data set from raw data')
+
+    output_format = output_format or (
+        'parquet' if output_filepath.endswith('.parquet') else 'jsonl')
+    # JSON lines are the checkpoint, parquet is written from them once every
+    # video is done
+    records_filepath = output_filepath if output_format == 'jsonl' \
+        else output_filepath + '.jsonl'
+
+    videos = list_videos(input_filepath)
+    done = read_done(records_filepath, ModelConsts.MODEL_VERSION)
+    pending = [video for video in videos if video not in done]
+    logger.info(f'{len(videos)} videos, {len(done)} already done, '
+                f'processing {len(pending)}')
+
+    failed = 0
+    with open(records_filepath, 'a') as f:
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initializer=init_worker)
+            records = pool.imap_unordered(process_video, pending)
+        else:
+            pool = None
+            init_worker()
+            records = map(process_video, pending)
+        try:
+            for index, record in enumerate(records, 1):
+                failed += 'error' in record
+                f.write(json.dumps(record, default=to_json) + '\n')
+                f.flush()
+                if index % 100 == 0:
+                    logger.info(f'{index}/{len(pending)} videos processed, '
+                                f'{failed} failed')
+        finally:
+            if pool is not None:
+                pool.terminate()
+    logger.info(f'{len(pending)} videos processed, {failed} failed')
+
+    if output_format == 'parquet':
+        write_parquet(records_filepath, output_filepath)
 
 
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
 
-    # not used in this stub but often useful for finding various files
-    project_dir = Path(__file__).resolve().parents[2]
-
-    # find .env automagically by walking up directories until it's found, then
-    # load up the .env entries as environment variables
-    load_dotenv(find_dotenv())
-
     main()
@@ -0,0 +1,106 @@
+import time
+from typing import Tuple
+
+from src.utils.video_utils import VideoUtils
+from src.utils import metrics
+from consts import FRAME_EVERY_X_SECONDS, ADAPTIVE_SAMPLING, \
+    COARSE_EVERY_X_SECONDS, ModelConsts
+
+
+def get_face_features(url: str, feature_extraction, spool=None, scheduler=None,
+                      identities=None) -> Tuple[bool, dict]:
+    """
+    Run a video file or URL through `feature_extraction`, a FeatureExtraction
+    or ProcessPoolFeatureExtraction
+
+    :param spool: VideoSpool the video is downloaded to before decoding
+    :param scheduler: VideoScheduler lowering the sampling of videos that would
+        not fit its budget
+    :param identities: UserIdentities of the video's user, people seen in their
+        previous videos
+    :return: has_faces and the info of every face cluster
+    """
+    if spool is None:
+        return extract_face_features(
+            url, feature_extraction, scheduler, identities)
+    with spool.local(url) as path:
+        # planned from the probe of the remote url when the cost was estimated
+        return extract_face_features(
+            path, feature_extraction, scheduler, identities, probe_key=url)
+
+
+def extract_face_features(
+        url: str, feature_extraction, scheduler=None, identities=None,
+        probe_key: str = None) -> Tuple[bool, dict]:
+    t1 = time.time()
+    every_x_seconds, seek, estimate = FRAME_EVERY_X_SECONDS, False, None
+    if scheduler is not None:
+        every_x_seconds, seek, estimate = scheduler.plan(
+            url, FRAME_EVERY_X_SECONDS, probe_key)
+        if every_x_seconds != FRAME_EVERY_X_SECONDS or seek:
+            metrics.inc('sampling_degraded')
+    video = VideoUtils(
+        url, streaming=True, seek=seek, downscale=True,
+        frame_every_x_seconds=every_x_seconds)
+    if not video.success:
+        raise ValueError(f"Unable to open video: {url}")
+    if ADAPTIVE_SAMPLING and every_x_seconds < COARSE_EVERY_X_SECONDS:
+        # sparse first pass, videos without faces end here
+        face_timestamps = feature_extraction.find_face_timestamps(
+            video.iterSampledFrames(
+                every_x_seconds=COARSE_EVERY_X_SECONDS, seek=True),
+            video.col_count, video.row_count)
+        if len(face_timestamps) == 0:
+            return False, None
+        video.refineAround(face_timestamps, COARSE_EVERY_X_SECONDS)
+    if ModelConsts.DETECTION_MODE == 'batch':
+        has_faces, info_clusters = feature_extraction.get_frames_features(
+            video.iterDistinctFrames(), weights=video.frame_weights,
+            identities=identities)
+    else:
+        # mosaics are built and analysed while the video is still being decoded
+        has_faces, info_clusters = feature_extraction.get_features(
+            video.merged_frames, prescaled=video.downscale,
+            weights=video.merged_weights, identities=identities)
+    if has_faces:
+        # durations are counted in frames sampled at this interval
+        for cluster in info_clusters.values():
+            cluster.frame_every_x_seconds = every_x_seconds
+    if scheduler is not None:
+        scheduler.observe(estimate, time.time() - t1)
+    return has_faces, info_clusters
+
+
+def thresh_skintone(score):
+    if score == None:
+         skin_colour = None
+    elif score <= 2:
+        skin_colour = 'dusky'
+    elif score >= 4.5:
+        skin_colour = 'fair'
+    elif score >2 and score < 4.5:
+        skin_colour = 'wheatish'
+    else: 
+        skin_colour = None
+    return skin_colour
+
+def process_result(result):
+    people = []
+    for i in range(len(result)):
+        person = {}
+        person['gender'] = result[i].gender
+        person['age'] = result[i].age
+        skin_tone = thresh_skintone(result[i].skin_tone)
+        if skin_tone == None:
+            person['skin_tone_score'] = None
+            person['skin_tone'] = None
+        else:
+            person['skin_tone_score'] = result[i].skin_tone
+            person['skin_tone'] = skin_tone
+        # sampled frames a person was seen on, including near-duplicate frames
+        # skipped before detection
+        seen = result[i].weight
+        person['duration'] = seen * (
+            result[i].frame_every_x_seconds or FRAME_EVERY_X_SECONDS)
+        people.append(person)
+    return people
@@ -0,0 +1,156 @@
+import cv2
+import numpy as np
+from typing import Iterable, Iterator, List, Tuple
+
+from insightface.app.common import Face
+from insightface.model_zoo.scrfd import distance2bbox, distance2kps
+
+from src.utils import metrics
+
+
+class BatchFaceDetector:
+    """
+    Runs the insightface SCRFD detection model on fixed-size batches of frames
+    straight through its onnxruntime session, instead of one merged image per
+    call.
+    """
+
+    def __init__(self, det_model, input_size: Tuple[int, int] = (640, 640),
+                 batch_size: int = 8) -> None:
+        self.det_model = det_model
+        self.session = det_model.session
+        self.input_size = tuple(input_size)
+        batch_dim = self.session.get_inputs()[0].shape[0]
+        # models exported with a static batch dimension only take one frame per
+        # run
+        self.batch_size = batch_size if not isinstance(batch_dim, int) \
+            else batch_dim
+        self.anchor_centers = {}
+
+    def preprocess(self, frame: np.ndarray) -> Tuple[np.ndarray, float]:
+        """
+        Letterbox a frame into the detector input size, same as SCRFD.detect
+        """
+        input_w, input_h = self.input_size
+        im_ratio = float(frame.shape[0]) / frame.shape[1]
+        if im_ratio > float(input_h) / input_w:
+            new_height = input_h
+            new_width = int(new_height / im_ratio)
+        else:
+            new_width = input_w
+            new_height = int(new_width * im_ratio)
+        det_scale = float(new_height) / frame.shape[0]
+        det_img = np.zeros((input_h, input_w, 3), dtype=np.uint8)
+        det_img[:new_height, :new_width] = cv2.resize(
+            frame, (new_width, new_height))
+        return det_img, det_scale
+
+    def get_anchor_centers(
+            self, height: int, width: int, stride: int) -> np.ndarray:
+        key = (height, width, stride)
+        if key not in self.anchor_centers:
+            anchor_centers = np.stack(
+                np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
+            anchor_centers = (anchor_centers * stride).reshape((-1, 2))
+            if self.det_model._num_anchors > 1:
+                anchor_centers = np.stack(
+                    [anchor_centers] * self.det_model._num_anchors,
+                    axis=1).reshape((-1, 2))
+            self.anchor_centers[key] = anchor_centers
+        return self.anchor_centers[key]
+
+    def decode(
+            self, net_outs: List[np.ndarray], batch_index: int, batch_len: int,
+            det_scale: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Decode the outputs of one frame of the batch into (k, 5) boxes with
+        scores and (k, 5, 2) keypoints
+        """
+        model = self.det_model
+        fmc = model.fmc
+        input_w, input_h = self.input_size
+        scores_list, bboxes_list, kpss_list = [], [], []
+        for idx, stride in enumerate(model._feat_stride_fpn):
+            outs = [net_outs[idx], net_outs[idx + fmc]]
+            if model.use_kps:
+                outs.append(net_outs[idx + fmc * 2])
+            if outs[0].ndim == 3:
+                outs = [out[batch_index] for out in outs]
+            else:
+                # batch folded into the first dimension
+                outs = [np.split(out, batch_len)[batch_index] for out in outs]
+
+            anchor_centers = self.get_anchor_centers(
+                input_h // stride, input_w // stride, stride)
+            scores = outs[0]
+            pos_inds = np.where(scores >= model.det_thresh)[0]
+            scores_list.append(scores[pos_inds])
+            bboxes_list.append(
+                distance2bbox(anchor_centers, outs[1] * stride)[pos_inds])
+            if model.use_kps:
+                kpss = distance2kps(anchor_centers, outs[2] * stride)
+                kpss_list.append(
+                    kpss.reshape((kpss.shape[0], -1, 2))[pos_inds])
+
+        scores = np.vstack(scores_list)
+        order = scores.ravel().argsort()[::-1]
+        pre_det = np.hstack((np.vstack(bboxes_list) / det_scale, scores)) \
+            .astype(np.float32, copy=False)
+        pre_det = pre_det[order, :]
+        keep = model.nms(pre_det)
+        kpss = None
+        if model.use_kps:
+            kpss = (np.vstack(kpss_list) / det_scale)[order][keep]
+        return pre_det[keep, :], kpss
+
+    def detect_batch(self, frames: List[np.ndarray]) -> List[List[Face]]:
+        """
+        Detect faces in a list of at most `batch_size` frames
+        """
+        det_imgs, det_scales = zip(
+            *[self.preprocess(frame) for frame in frames])
+        model = self.det_model
+        blob = cv2.dnn.blobFromImages(
+            list(det_imgs), 1.0/model.input_std, self.input_size,
+            (model.input_mean, model.input_mean, model.input_mean),
+            swapRB=True)
+        net_outs = self.session.run(
+            model.output_names, {model.input_name: blob})
+
+        faces = []
+        for batch_index, det_scale in enumerate(det_scales):
+            det, kpss = self.decode(
+                net_outs, batch_index, len(frames), det_scale)
+            faces.append([Face(bbox=det[i, :4],
+                               kps=None if kpss is None else kpss[i],
+                               det_score=det[i, 4])
+                          for i in range(det.shape[0])])
+        return faces
+
+    def detect(self, frames: Iterable[Tuple[float, np.ndarray]]
+               ) -> Iterator[Tuple[int, float, np.ndarray, List[Face]]]:
+        """
+        Detect faces in a stream of (timestamp, frame) pairs, `batch_size`
+        frames per run
+
+        yield:
+            frame_index: int, index of the frame in the stream
+            timestamp: float, timestamp of the frame in milliseconds
+            frame: np.ndarray, the frame
+            faces: list of detected faces
+        """
+        batch = []
+        for frame_index, (timestamp, frame) in enumerate(frames):
+            batch.append((frame_index, timestamp, frame))
+            if len(batch) == self.batch_size:
+                yield from self.flush(batch)
+                batch = []
+        if len(batch) > 0:
+            yield from self.flush(batch)
+
+    def flush(self, batch
+              ) -> Iterator[Tuple[int, float, np.ndarray, List[Face]]]:
+        with metrics.stage('detection'):
+            faces = self.detect_batch([frame for _, _, frame in batch])
+        for (frame_index, timestamp, frame), frame_faces in zip(batch, faces):
+            yield frame_index, timestamp, frame, frame_faces
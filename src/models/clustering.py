@@ -0,0 +1,156 @@
+import numpy as np
+from typing import List
+
+
+def stack_encodings(encodings) -> np.ndarray:
+    """
+    Stack 128-d face encodings into a (n, 128) float32 matrix without touching
+    the input
+    """
+    if len(encodings) == 0:
+        return np.empty((0, 128), dtype=np.float32)
+    return np.asarray(np.stack(encodings), dtype=np.float32).reshape(
+        len(encodings), -1)
+
+
+def leader_clusters(X: np.ndarray, tolerance: float,
+                    block_size: int = 256) -> List[np.ndarray]:
+    """
+    Greedy leader clustering: the first unassigned face takes every unassigned
+    face within `tolerance` of it, same as repeated
+    'face_recognition.compare_faces'. Leaders are always the lowest unassigned
+    index, so distances from the next `block_size` candidate leaders are
+    computed with a single matrix product.
+    """
+    n = len(X)
+    sq_norms = np.einsum('ij,ij->i', X, X)
+    tol2 = tolerance ** 2
+    assigned = np.zeros(n, dtype=bool)
+    clusters = []
+    for start in range(0, n, block_size):
+        candidates = np.arange(start, min(start+block_size, n))
+        remaining = np.nonzero(~assigned[start:])[0] + start
+        if remaining.size == 0:
+            break
+        dist2 = sq_norms[candidates, None] + sq_norms[None, remaining] \
+            - 2 * (X[candidates] @ X[remaining].T)
+        for k, leader in enumerate(candidates):
+            if assigned[leader]:
+                continue
+            matching = (dist2[k] <= tol2) & ~assigned[remaining]
+            matching[np.searchsorted(remaining, leader)] = True
+            members = remaining[matching]
+            assigned[members] = True
+            clusters.append(members)
+    return clusters
+
+
+def component_clusters(X: np.ndarray, tolerance: float,
+                       block_size: int = 2048) -> List[np.ndarray]:
+    """
+    Connected components of the graph linking faces within `tolerance`,
+    distances are computed block by block to bound memory
+    """
+    n = len(X)
+    sq_norms = np.einsum('ij,ij->i', X, X)
+    tol2 = tolerance ** 2
+    src, dst = [], []
+    for start in range(0, n, block_size):
+        block = X[start:start+block_size]
+        dist2 = sq_norms[start:start+block_size, None] \
+            + sq_norms[None, start:] - 2 * (block @ X[start:].T)
+        i, j = np.nonzero(dist2 <= tol2)
+        src.append(i + start)
+        dst.append(j + start)
+    src, dst = np.concatenate(src), np.concatenate(dst)
+
+    # propagate the smallest index through every edge until stable
+    labels = np.arange(n)
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, src, labels[dst])
+        np.minimum.at(new_labels, dst, labels[src])
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    order = np.argsort(labels, kind='stable')
+    splits = np.nonzero(np.diff(labels[order]))[0] + 1
+    return np.split(order, splits)
+
+
+def cluster_encodings(encodings, tolerance: float = 0.6, min_size: int = 6,
+                      method: str = 'leader', block_size: int = 2048,
+                      weights=None) -> List[List[int]]:
+    """
+    Group face encodings of the same person, clusters smaller than `min_size`
+    are dropped
+
+    :param encodings: list or (n, 128) array of face encodings
+    :param float tolerance: lower value --> less matches (more clusters)
+    :param int min_size: minimum number of faces kept per cluster
+    :param str method: 'leader' (greedy, first face of each cluster leads) or
+        'components'
+    :param weights: number of sampled frames each face stands for, `min_size`
+        applies to their sum
+    :return: list of clusters, each a list of indices into `encodings`
+    """
+    X = stack_encodings(encodings)
+    if len(X) == 0:
+        return []
+    if method == 'leader':
+        clusters = leader_clusters(X, tolerance)
+    elif method == 'components':
+        clusters = component_clusters(X, tolerance, block_size)
+    else:
+        raise ValueError(f"Unknown clustering method: {method}")
+
+    if weights is None:
+        return [cluster.tolist() for cluster in clusters
+                if len(cluster) >= min_size]
+    weights = np.asarray(weights)
+    return [cluster.tolist() for cluster in clusters
+            if weights[cluster].sum() >= min_size]
+
+
+class FaceCluster():
+    """
+    Aggregated attributes of the faces of one person, without the faces
+    themselves
+
+    :param float gender: median gender of the faces
+    :param float age: median age of the faces
+    :param float skin_tone: mean skin tone of the faces, nan when none could be
+        scored
+    :param centroid: mean encoding of the faces, float32
+    :param int count: number of faces detected, including the tracked faces
+        that were not encoded
+    :param int weight: number of sampled frames the person was seen on
+    :param first_seen: timestamp (ms) of the first face, None for mosaics
+    :param last_seen: timestamp (ms) of the last face, None for mosaics
+    :param frame_every_x_seconds: sampling interval of the video, None for the
+        configured one
+    """
+    __slots__ = (
+        'gender', 'age', 'skin_tone', 'centroid', 'count', 'weight',
+        'first_seen', 'last_seen', 'frame_every_x_seconds')
+
+    def __init__(self, gender: float, age: float, skin_tone: float,
+                 centroid: np.ndarray, count: int, weight: int,
+                 first_seen: float = None, last_seen: float = None,
+                 frame_every_x_seconds: float = None) -> None:
+        self.gender = gender
+        self.age = age
+        self.skin_tone = skin_tone
+        self.centroid = centroid
+        self.count = count
+        self.weight = weight
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.frame_every_x_seconds = frame_every_x_seconds
+
+    def __repr__(self) -> str:
+        return (f"FaceCluster(gender={self.gender}, age={self.age}, "
+                f"skin_tone={self.skin_tone}, count={self.count}, "
+                f"weight={self.weight})")
@@ -1,160 +1,579 @@
 import cv2
+import hashlib
+import os
+import threading
 import numpy as np
-import time
-import math
 
-from typing import Tuple, List
-from collections import Counter
+from typing import Tuple, List, Iterable
 
 # local imports
 from src.models.skin_tone import SkinToneDetection
-from consts import INSIGHTFACE_MODEL_URL
-# FaceAnalysis [Age & Gender]
-import insightface
-from insightface.app import FaceAnalysis
-from insightface.data import get_image as ins_get_image
+from src.models.clustering import cluster_encodings, stack_encodings, \
+    FaceCluster
+from src.models.pairing import pair_detections, location_centers
+from src.models.tracking import FaceTracker
+from src.utils.video_utils import VideoUtils, MosaicBuilder
+from src.utils import metrics
+from consts import INSIGHTFACE_MODEL_URL, MODEL_CACHE_DIR, ModelConsts, \
+    IdentityConsts
 
-# FaceRecognition & Encoding
-import face_recognition
 
-insightface.utils.storage.BASE_REPO_URL = INSIGHTFACE_MODEL_URL
+def find_face_timestamps(frames: Iterable[Tuple[float, np.ndarray]],
+                         detect_locations, col_count: int = 10,
+                         row_count: int = 4) -> List[float]:
+    """
+    Timestamps of the (timestamp, frame) pairs showing at least one face,
+    detected with `detect_locations` on downscaled merged frames
+    """
+    builder = MosaicBuilder(col_count, row_count, downscale=True)
+    face_timestamps, timestamps = [], []
+
+    def probe(merged_frame):
+        with metrics.stage('probe'):
+            locations = detect_locations(merged_frame)
+        if len(locations) > 0:
+            row, col = FeatureExtraction.location_cells(
+                locations, merged_frame.shape, builder.last_weights.shape)
+            # faces in blank cells of the last merged frame are ignored
+            cells = np.unique(row * col_count + col)
+            face_timestamps.extend(timestamps[cell] for cell in cells
+                                   if cell < len(timestamps))
+        timestamps.clear()
+
+    for timestamp, frame in frames:
+        timestamps.append(timestamp)
+        merged_frame = builder.add(frame)
+        if merged_frame is not None:
+            probe(merged_frame)
+    merged_frame = builder.flush()
+    if merged_frame is not None:
+        probe(merged_frame)
+    return face_timestamps
+
+
+def get_model_root(model_url: str = INSIGHTFACE_MODEL_URL) -> str:
+    """
+    Local insightface model directory, one per model repository so restarts
+    never re-fetch models
+    """
+    key = hashlib.sha1(str(model_url).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(os.path.expanduser(MODEL_CACHE_DIR), key)
+
 
 class FeatureExtraction:
-    def __init__(self) -> None:
-        self.face_analysis = FaceAnalysis(
-            allowed_modules=['detection', 'genderage'])
-        self.face_analysis.prepare(ctx_id=0, det_size=(640, 640))
+    def __init__(
+            self, dual_detector: bool = ModelConsts.DUAL_DETECTOR,
+            pairing_one_to_one: bool = False,
+            pairing_max_distance: float = None,
+            skin_tone_samples: int = ModelConsts.SKIN_TONE_SAMPLES,
+            known_skin_tone_samples: int =
+            IdentityConsts.KNOWN_SKIN_TONE_SAMPLES,
+            track_faces: bool = ModelConsts.TRACK_FACES, face_analysis=None,
+            face_encoder=None, lazy: bool = False) -> None:
+        # dual_detector keeps the legacy path running dlib's HOG detector next
+        # to insightface
+        self.dual_detector = dual_detector
+        self.pairing_one_to_one = pairing_one_to_one
+        self.pairing_max_distance = pairing_max_distance
+        self.skin_tone_detection = SkinToneDetection()
+        self.skin_tone_samples = skin_tone_samples
+        # faces averaged for people matching a known identity of the user
+        self.known_skin_tone_samples = known_skin_tone_samples
+        # link faces of consecutive frames and only encode a few of every track
+        self.track_faces = track_faces
+        # face_analysis and face_encoder can be swapped for stubs with the same
+        # interface
+        self.face_encoder = face_encoder
+        self.face_analysis = face_analysis
+        self.batch_detector = None
+        self.load_lock = threading.Lock()
+        self.ready = threading.Event()
+        if not lazy:
+            self.load()
+
+    def load(self) -> None:
+        """
+        Import and prepare the models on first use, `lazy=True` defers this
+        until the first video
+        """
+        with self.load_lock:
+            if self.face_encoder is None:
+                # FaceRecognition & Encoding
+                import face_recognition
+                self.face_encoder = face_recognition
+            if self.face_analysis is None:
+                # FaceAnalysis [Age & Gender]
+                import insightface
+                from insightface.app import FaceAnalysis
+                insightface.utils.storage.BASE_REPO_URL = INSIGHTFACE_MODEL_URL
+                self.face_analysis = FaceAnalysis(
+                    root=get_model_root(),
+                    allowed_modules=['detection', 'genderage'])
+                self.face_analysis.prepare(ctx_id=0, det_size=(640, 640))
+
+    def warm_up(self) -> None:
+        """
+        Load the models and run one dummy inference per model, then signal
+        `ready`
+        """
+        self.load()
+        dummy = np.zeros((640, 640, 3), dtype=np.uint8)
+        self.face_analysis.get(dummy)
+        genderage = self.face_analysis.models.get('genderage')
+        if genderage is not None:
+            try:
+                from insightface.app.common import Face
+            except ImportError:  # stub models
+                Face = dict
+            genderage.get(
+                dummy,
+                Face(bbox=np.array([220, 220, 420, 420], dtype=np.float32)))
+        self.face_encoder.face_encodings(
+            dummy, known_face_locations=[(220, 420, 420, 220)])
+        self.ready.set()
+
+    def detect_locations(
+            self, merged_frame: np.ndarray) -> List[Tuple[int, int, int, int]]:
+        """
+        Face locations of an image from the detection model alone
+        """
+        det_model = getattr(self.face_analysis, 'det_model', None)
+        if det_model is not None:
+            bboxes, _ = det_model.detect(
+                merged_frame, max_num=0, metric='default')
+            faces = [{'bbox': bbox[:4]} for bbox in bboxes]
+        else:
+            faces = self.face_analysis.get(merged_frame)
+        return self.bbox_to_locations(faces, merged_frame.shape)[1]
+
+    def find_face_timestamps(
+            self, frames: Iterable[Tuple[float, np.ndarray]],
+            col_count: int = 10, row_count: int = 4) -> List[float]:
+        """
+        Timestamps of the (timestamp, frame) pairs showing at least one face,
+        e.g. of a coarse first pass over a video
+        """
+        self.load()
+        return find_face_timestamps(
+            frames, self.detect_locations, col_count, row_count)
+
+    def get_batch_detector(self):
+        if self.batch_detector is None:
+            from src.models.batch_detection import BatchFaceDetector
+            self.batch_detector = BatchFaceDetector(
+                self.face_analysis.det_model,
+                input_size=ModelConsts.DET_INPUT_SIZE,
+                batch_size=ModelConsts.DET_BATCH_SIZE)
+        return self.batch_detector
+
+    def new_tracker(self) -> FaceTracker:
+        if not self.track_faces:
+            return None
+        return FaceTracker(
+            samples=ModelConsts.TRACK_SAMPLES,
+            sample_every=ModelConsts.TRACK_SAMPLE_EVERY)
 
-    def get_faces_raw_info(self, merged_frames_list: List[np.ndarray]) -> Tuple[List[np.ndarray], List[np.ndarray], List[np.ndarray]]:
+    def get_faces_raw_info(
+            self, merged_frames_list: List[np.ndarray],
+            prescaled: bool = False, weights=None
+    ) -> Tuple[List[np.ndarray], List[np.ndarray], List[np.ndarray]]:
         faces_details = []
         locations = []
         encodings = []
-        face_crops = []
-        for merged_frame in merged_frames_list:
-            # print(merged_frame.shape)
-            h, w, _ = merged_frame.shape
-            area = (h * w)/10000
-            f = -0.0001*area + 0.75
-            if f > 1:
-                f = 1
-            elif f < 0:
-                f = 0.2
-            merged_frame = cv2.resize(merged_frame, (0, 0), fx=f, fy=f)
+        skin_tones = []
+        face_weights = []
+        # tracking needs the cell grid of every merged frame
+        tracker = self.new_tracker() if weights is not None else None
+        frame_offset = 0
+        for merged_index, merged_frame in enumerate(merged_frames_list):
+            # weights of a lazily merged frame are known once it is yielded
+            cell_weights = weights[merged_index] \
+                if weights is not None else None
+            _faces_details, _face_locations, _encodings, _skin_tones, \
+                _face_weights = self.get_merged_frame_raw_info(
+                    merged_frame, prescaled, cell_weights, tracker,
+                    frame_offset)
+            faces_details += _faces_details
+            locations += _face_locations
+            encodings += _encodings
+            skin_tones += _skin_tones
+            face_weights += _face_weights
+            if cell_weights is not None:
+                frame_offset += cell_weights.size
+
+        face_counts = None
+        if tracker is not None:
+            # entries also stand for the faces of their track that were not
+            # encoded, tracked faces hold their entry index until every frame
+            # is tracked
+            face_counts = [tracker.counts[entry] for entry in face_weights]
+            face_weights = [tracker.weights[entry] for entry in face_weights]
+        return faces_details, locations, encodings, skin_tones, \
+            face_weights, face_counts
+
+    def get_merged_frame_raw_info(self, merged_frame: np.ndarray,
+                                  prescaled: bool = False,
+                                  cell_weights: np.ndarray = None,
+                                  tracker: FaceTracker = None,
+                                  frame_offset: int = 0):
+        """
+        Detect, pair and encode the faces of a single merged frame,
+        `cell_weights` holds the weight of every (row, col) cell of the merged
+        frame. With a `tracker` only the faces that start or sample a track are
+        encoded, cells are numbered from `frame_offset`, and the returned
+        weights are the tracker entry of every face as entry weights grow with
+        later frames.
+        """
+        # print(merged_frame.shape)
+        with metrics.stage('detection'):
+            if not prescaled:
+                h, w, _ = merged_frame.shape
+                f = VideoUtils.getScaleFactor(h, w)
+                merged_frame = cv2.resize(merged_frame, (0, 0), fx=f, fy=f)
             # print(merged_frame.shape)
 
-            t1 = time.time()
-            faces_details += self.face_analysis.get(merged_frame)
-            _face_locations = face_recognition.face_locations(merged_frame)
-            locations += _face_locations
-            encodings += face_recognition.face_encodings(
+            _faces_details = self.face_analysis.get(merged_frame)
+            if self.dual_detector:
+                _face_locations = self.face_encoder.face_locations(
+                    merged_frame)
+                # pair every dlib location with an insightface face of this
+                # merged frame
+                bboxes = [face_detail['bbox']
+                          for face_detail in _faces_details]
+                loc_idx, det_idx = pair_detections(
+                    _face_locations, bboxes,
+                    one_to_one=self.pairing_one_to_one,
+                    max_distance=self.pairing_max_distance)
+                _face_locations = [_face_locations[i] for i in loc_idx]
+                _faces_details = [_faces_details[j] for j in det_idx]
+            else:
+                _faces_details, _face_locations = self.bbox_to_locations(
+                    _faces_details, merged_frame.shape)
+        metrics.inc('faces_detected', len(_face_locations))
+        _face_weights = self.location_weights(
+            _face_locations, merged_frame.shape, cell_weights)
+        if tracker is not None and cell_weights is not None \
+                and len(_face_locations) > 0:
+            with metrics.stage('tracking'):
+                entries = self.track_cells(
+                    tracker, _face_locations, merged_frame.shape,
+                    cell_weights, frame_offset, _face_weights)
+            keep = entries >= 0
+            _faces_details = [d for d, k in zip(_faces_details, keep) if k]
+            _face_locations = [l for l, k in zip(_face_locations, keep) if k]
+            _face_weights = entries[keep].tolist()
+        with metrics.stage('encoding'):
+            _encodings = self.face_encoder.face_encodings(
                 merged_frame, known_face_locations=_face_locations)
 
-            for location in _face_locations:
-                face_crop = merged_frame[location[0]:location[2], location[3]:location[1]]
-                face_crops.append(face_crop)
+        _skin_tones = self.score_skin_tones(merged_frame, _face_locations)
 
-            print("Time Taken:", time.time()-t1)
+        return _faces_details, _face_locations, _encodings, _skin_tones, \
+            _face_weights
 
-        return faces_details, locations, encodings, face_crops
+    def score_skin_tones(self, image: np.ndarray, locations) -> List[float]:
+        """
+        Skin tone of every face of an image, nan where it shows too little
+        skin. Faces are scored as they are detected so no crop outlives its
+        frame.
+        """
+        with metrics.stage('skin_tone'):
+            return self.skin_tone_detection.imgs2skintone(
+                [image[top:bottom, left:right]
+                 for top, right, bottom, left in locations]).tolist()
 
-    def calc_distance(self, center_cord, faces_details):
+    @staticmethod
+    def location_cells(locations, shape, grid: Tuple[int, int]
+                       ) -> Tuple[np.ndarray, np.ndarray]:
         """
-        Pair face encodeing from 'face_recognition' with face details from 'insightface' based on location
+        (row, col) of the merged frame cell holding the center of every
+        location
+        """
+        rows, cols = grid
+        centers = location_centers(locations)
+        col = np.clip(
+            (centers[:, 0] * cols / shape[1]).astype(int), 0, cols - 1)
+        row = np.clip(
+            (centers[:, 1] * rows / shape[0]).astype(int), 0, rows - 1)
+        return row, col
+
+    @staticmethod
+    def location_weights(
+            locations, shape, cell_weights: np.ndarray = None) -> List[int]:
+        """
+        Weight of the merged frame cell holding the center of every location
+        """
+        if cell_weights is None or len(locations) == 0:
+            return [1] * len(locations)
+        row, col = FeatureExtraction.location_cells(
+            locations, shape, cell_weights.shape)
+        return cell_weights[row, col].tolist()
+
+    @staticmethod
+    def track_cells(tracker: FaceTracker, locations, shape,
+                    cell_weights: np.ndarray, frame_offset: int,
+                    weights: List[int]) -> np.ndarray:
+        """
+        Feed the faces of a merged frame to `tracker` cell by cell, each cell
+        being one sampled frame
+
+        return:
+            entries: np.ndarray, index in `tracker.weights` of the faces to
+                encode, -1 for the others
+        """
+        rows, cols = cell_weights.shape
+        row, col = FeatureExtraction.location_cells(
+            locations, shape, cell_weights.shape)
+        cell_h, cell_w = shape[0] / rows, shape[1] / cols
+        # locations relative to their own cell
+        origins = np.stack(
+            [row * cell_h, col * cell_w, row * cell_h, col * cell_w], axis=1)
+        relative = np.asarray(locations, dtype=np.float32) - origins
+        cells = row * cols + col
+        weights = np.asarray(weights)
+        entries = np.full(len(locations), -1, dtype=np.int64)
+        for cell in np.unique(cells):
+            idx = np.nonzero(cells == cell)[0]
+            start = len(tracker.weights)
+            # entries of a frame are created in the order of its faces
+            is_entry = tracker.update(
+                frame_offset + int(cell), relative[idx], weights[idx])
+            entries[idx[is_entry]] = start + np.arange(
+                np.count_nonzero(is_entry))
+        return entries
+
+    def get_frames_raw_info(self, frames: Iterable[Tuple[float, np.ndarray]],
+                            weights=None):
         """
-        p0, p1 = center_cord
-        dist = []
-        min_dist = 10000
+        Detect faces on sampled frames in fixed-size batches, keeping the frame
+        index and timestamp of every face. With tracking, gender, age and
+        encodings are only computed for the faces that start or sample a track.
+        """
+        faces_details = []
+        locations = []
+        encodings = []
+        skin_tones = []
+        frame_indexes = []
+        timestamps = []
+        face_weights = []
+        genderage = self.face_analysis.models['genderage']
+        tracker = self.new_tracker()
+        detections = self.get_batch_detector().detect(frames)
+        for frame_index, timestamp, frame, _faces_details in detections:
+            _faces_details, _face_locations = self.bbox_to_locations(
+                _faces_details, frame.shape)
+            if len(_face_locations) == 0:
+                continue
+            metrics.inc('faces_detected', len(_face_locations))
+            # weight of a frame is known once it is yielded
+            weight = 1 if weights is None else weights[frame_index]
+            _face_weights = [weight] * len(_face_locations)
+            if tracker is not None:
+                with metrics.stage('tracking'):
+                    keep = tracker.update(
+                        frame_index, _face_locations, _face_weights)
+                _faces_details = [
+                    d for d, k in zip(_faces_details, keep) if k]
+                _face_locations = [
+                    l for l, k in zip(_face_locations, keep) if k]
+                _face_weights = [
+                    w for w, k in zip(_face_weights, keep) if k]
+                if len(_face_locations) == 0:
+                    continue
+            with metrics.stage('genderage'):
+                for face_detail in _faces_details:
+                    genderage.get(frame, face_detail)
+            faces_details += _faces_details
+            locations += _face_locations
+            with metrics.stage('encoding'):
+                encodings += self.face_encoder.face_encodings(
+                    frame, known_face_locations=_face_locations)
+            skin_tones += self.score_skin_tones(frame, _face_locations)
+            frame_indexes += [frame_index] * len(_face_locations)
+            timestamps += [timestamp] * len(_face_locations)
+            face_weights += _face_weights
+
+        face_counts = None
+        if tracker is not None:
+            face_weights, face_counts = tracker.weights, tracker.counts
+        return faces_details, locations, encodings, skin_tones, \
+            frame_indexes, timestamps, face_weights, face_counts
+
+    @staticmethod
+    def bbox_to_locations(faces_details, shape):
+        """
+        Convert insightface (x1, y1, x2, y2) boxes to 'face_recognition' (top,
+        right, bottom, left) locations
+        """
+        h, w = shape[:2]
+        kept_details, locations = [], []
         for face_detail in faces_details:
-            box = face_detail['bbox']
-            box[1], box[0], box[3], box[2] = box[0], box[1], box[2], box[3]
-            s0, s1 = (int(box[1] + box[3])//2, int(box[0] + box[2])//2)
-            # Edit this line to [0]s and [1]s
-            dist_ = math.sqrt(abs(p0 - s0)**2 + abs(p1 - s1)**2)
-            if dist_ < min_dist:
-                min_dist = dist_
-                min_dist_detail = face_detail
-            dist.append(dist_)  # Save data to list
-        return min_dist_detail
-
-    def merge_info(self, faces_details, locations, encodings, face_crops):
-        merged_info = []
-        for i in range(len(locations)):
-            box = locations[i]
-            center_cord = (int(box[1] + box[3])//2, int(box[0] + box[2])//2)
-            info = self.calc_distance(center_cord, faces_details)
-            merged_info.append(
-                {'location': box, 'encoding': encodings[i], 'face_crop': face_crops[i], 'gender': info['gender'], 'age': info['age']})
+            x1, y1, x2, y2 = face_detail['bbox']
+            top, bottom = max(int(y1), 0), min(int(y2), h)
+            left, right = max(int(x1), 0), min(int(x2), w)
+            if bottom > top and right > left:
+                kept_details.append(face_detail)
+                locations.append((top, right, bottom, left))
+        return kept_details, locations
+
+    def merge_info(self, faces_details, locations, encodings, skin_tones,
+                   weights=None, counts=None):
+        """
+        Pack paired faces into compact per-face arrays, `weights` is the number
+        of sampled frames each face stands for and `counts` the number of
+        detected faces, more than one for the tracked faces that were not
+        encoded
+        """
+        ones = np.ones(len(locations), dtype=np.int32)
+        return {
+            'weights': ones if weights is None
+            else np.asarray(weights, dtype=np.int32),
+            'counts': ones if counts is None
+            else np.asarray(counts, dtype=np.int32),
+            'locations': np.asarray(locations, dtype=np.int32).reshape(-1, 4),
+            'encodings': stack_encodings(encodings),
+            'skin_tones': np.asarray(skin_tones, dtype=np.float64),
+            'gender': np.array(
+                [face_detail['gender'] for face_detail in faces_details]),
+            'age': np.array(
+                [face_detail['age'] for face_detail in faces_details]),
+        }
+
+    def merge_frame_info(self, faces_details, locations, encodings, skin_tones,
+                         frame_indexes, timestamps, weights=None, counts=None):
+        """
+        Compact per-face arrays, with the frame index and timestamp (ms) of
+        every face
+        """
+        merged_info = self.merge_info(
+            faces_details, locations, encodings, skin_tones, weights, counts)
+        merged_info['frame_index'] = np.asarray(frame_indexes, dtype=np.int32)
+        merged_info['timestamps'] = np.asarray(timestamps, dtype=np.float64)
         return merged_info
 
-    def cluster_faces(self, encodings):
-        clusters = []
+    def cluster_faces(self, encodings, weights=None):
         tolerance = 0.6  # lower value --> less matches (more clusters)
-        remaining = [0]
-        all_used = []
-        while len(remaining) > 0:
-            enc1 = encodings[remaining[0]]  # get first encoding of remaining
-            compare_faces = np.array(face_recognition.api.compare_faces(
-                encodings, enc1, tolerance=tolerance))
-            matching = np.where(compare_faces == True)[0].tolist()
-            remaining = np.where(compare_faces == False)[0].tolist()
-            for m in matching:
-                encodings[m] = np.full((128), np.inf)
-            clusters.append(matching)
-            all_used.extend(matching)
-            remaining = list(set(remaining) - set(all_used))
-
-        # remove clusters with less than 5 faces
-        clusters = [cluster for cluster in clusters if len(cluster) > 5]
-        return clusters
-
-    def aggregate_cluster_info(self, clusters, merged_info):
-        info_clusters = {}
-        for cluster_index in range(len(clusters)):
-            info_clusters[cluster_index] = {
-                'gender': [], 'age': [], 'skin_tone': [], 'locations': [], 'encodings': [], 'face_crops': []}
-            for i in clusters[cluster_index]:
-                info_clusters[cluster_index]['locations'].append(
-                    merged_info[i]['location'])
-                info_clusters[cluster_index]['encodings'].append(
-                    merged_info[i]['encoding'])
-                info_clusters[cluster_index]['gender'].append(
-                    merged_info[i]['gender'])
-                info_clusters[cluster_index]['age'].append(
-                    merged_info[i]['age'])
-                info_clusters[cluster_index]['face_crops'].append(
-                    merged_info[i]['face_crop'])
-                is_valid, skin_tone = SkinToneDetection(
-                ).img2skintone(merged_info[i]['face_crop'])
-                if is_valid:
-                    info_clusters[cluster_index]['skin_tone'].append(skin_tone)
-
-            info_clusters[cluster_index]['count'] = len(
-                info_clusters[cluster_index]['age'])
-
-        for index_key in info_clusters.keys():
-            for attribute_key in ['gender', 'age']:
-                info_clusters[index_key][attribute_key] = np.median(
-                    info_clusters[index_key][attribute_key])
-            # info_clusters[index_key]['skin_tone'] = Counter(info_clusters[index_key]['skin_tone']).most_common(1)[0][0]
-            info_clusters[index_key]['skin_tone'] = np.mean(
-                info_clusters[index_key]['skin_tone'])
+        # remove clusters seen on 5 sampled frames or less
+        return cluster_encodings(
+            encodings, tolerance=tolerance, min_size=6, weights=weights)
+
+    def aggregate_cluster_info(self, clusters, merged_info, identities=None):
+        """
+        One `FaceCluster` per cluster, the result holds no per-face data.
 
+        :param identities: UserIdentities of the video's user, attributes of
+            clusters matching one of them are blended with the stored ones
+        """
+        info_clusters = {}
+        for cluster_index, cluster in enumerate(clusters):
+            centroid = merged_info['encodings'][cluster].mean(
+                axis=0, dtype=np.float32)
+            skin_tones = merged_info['skin_tones'][cluster]
+            weights = merged_info['weights'][cluster]
+            count = int(merged_info['counts'][cluster].sum())
+            first_seen = last_seen = None
+            if 'frame_index' in merged_info:
+                # faces of a person found on sampled frames, duration counts
+                # each frame once
+                _, first = np.unique(
+                    merged_info['frame_index'][cluster], return_index=True)
+                weights = weights[first]
+                timestamps = merged_info['timestamps'][cluster]
+                first_seen = float(timestamps.min())
+                last_seen = float(timestamps.max())
+            gender = float(np.median(merged_info['gender'][cluster]))
+            age = float(np.median(merged_info['age'][cluster]))
+            if identities is None:
+                skin_tone = self.cluster_skin_tone(
+                    skin_tones, self.skin_tone_samples)
+            else:
+                attributes = self.cluster_attributes(gender, age, skin_tones)
+                known, (gender, age, skin_tone) = identities.match_or_update(
+                    centroid, count, attributes)
+                if known is not None:
+                    metrics.inc('identities_matched')
+                    # the stored gender is the share of faces seen as male,
+                    # results keep 0 or 1
+                    gender = float(np.round(gender))
+            info_clusters[cluster_index] = FaceCluster(
+                gender=gender,
+                age=age,
+                skin_tone=skin_tone,
+                centroid=centroid,
+                count=count,
+                weight=int(weights.sum()),
+                first_seen=first_seen,
+                last_seen=last_seen)
         return info_clusters
 
-    def get_features(self, merged_frames_list: List[np.ndarray]):
-        faces_details, locations, encodings, face_crop = self.get_faces_raw_info(
-            merged_frames_list)
+    def cluster_skin_tone(self, skin_tones: np.ndarray, sample: int) -> float:
+        """
+        Mean skin tone of the faces of a cluster, of `sample` evenly spaced
+        ones when set
+        """
+        if sample and len(skin_tones) > sample:
+            skin_tones = skin_tones[
+                np.linspace(0, len(skin_tones) - 1, sample).astype(int)]
+        skin_tones = skin_tones[~np.isnan(skin_tones)]
+        return float(np.mean(skin_tones)) if len(skin_tones) > 0 else np.nan
+
+    def cluster_attributes(self, gender: float, age: float,
+                           skin_tones: np.ndarray):
+        """
+        Attributes of a cluster given the identity it matched, see
+        `IdentityIndex.match_or_update`
+        """
+        def attributes(known):
+            sample = self.known_skin_tone_samples if known is not None \
+                else self.skin_tone_samples
+            return gender, age, self.cluster_skin_tone(skin_tones, sample)
+        return attributes
+
+    def get_features(self, merged_frames_list: List[np.ndarray],
+                     prescaled: bool = False, weights=None, identities=None):
+        """
+        :param weights: per merged frame, the (rows, cols) weights of its
+            cells, e.g. `VideoUtils.merged_weights`
+        :param identities: UserIdentities of the video's user, see
+            `aggregate_cluster_info`
+        """
+        self.load()
+        faces_details, locations, encodings, skin_tones, face_weights, \
+            face_counts = self.get_faces_raw_info(
+                merged_frames_list, prescaled, weights)
 
         if len(locations) > 0 and len(faces_details) > 0:
             merged_info = self.merge_info(
-                faces_details, locations, encodings, face_crop)
-            faces_clusters = self.cluster_faces(encodings)
+                faces_details, locations, encodings, skin_tones, face_weights,
+                face_counts)
+            return self.get_clusters_features(merged_info, identities)
+        else:
+            return False, None
+
+    def get_frames_features(self, frames: Iterable[Tuple[float, np.ndarray]],
+                            weights=None, identities=None):
+        """
+        Same as `get_features` on a stream of (timestamp, frame) pairs using
+        batched detection, `weights` holds the weight of every frame, e.g.
+        `VideoUtils.frame_weights`
+        """
+        self.load()
+        raw_info = self.get_frames_raw_info(frames, weights)
+        if len(raw_info[1]) > 0:
+            merged_info = self.merge_frame_info(*raw_info)
+            return self.get_clusters_features(merged_info, identities)
+        else:
+            return False, None
+
+    def get_clusters_features(self, merged_info, identities=None):
+        with metrics.stage('cluster_faces'):
+            faces_clusters = self.cluster_faces(
+                merged_info['encodings'], merged_info['weights'])
+        with metrics.stage('aggregate_cluster_info'):
             info_clusters = self.aggregate_cluster_info(
-                faces_clusters, merged_info)
-            if len(info_clusters) > 0:
-                # keys = ['gender', 'age', 'skin_tone', 'locations', 'encodings', 'face_crops']
-                return True, info_clusters
-            else:
-                return False, None
+                faces_clusters, merged_info, identities)
+        metrics.inc('clusters', len(info_clusters))
+        if len(info_clusters) > 0:
+            return True, info_clusters
         else:
             return False, None
@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+from typing import Callable, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+
+def identity_dtype(dim: int) -> np.dtype:
+    return np.dtype([('centroid', np.float32, (dim,)),
+                     ('gender', np.float32), ('age', np.float32),
+                     ('skin_tone', np.float32), ('count', np.int32),
+                     ('last_used', np.float64)])
+
+
+class Identity(NamedTuple):
+    slot: int
+    centroid: np.ndarray
+    gender: float
+    age: float
+    skin_tone: float
+    count: int
+
+
+def blend(known_value: float, known_count: int, value: float,
+          count: int) -> float:
+    """
+    Mean of a stored and a new attribute weighted by their face counts, nan
+    values are ignored
+    """
+    if np.isnan(known_value):
+        return value
+    if np.isnan(value):
+        return known_value
+    return (known_value * known_count + value * count) / (known_count + count)
+
+
+class IdentityIndex():
+    """
+    Centroid encodings and attributes of the people already seen in the videos
+    of each user, one memory-mapped file of at most `max_per_user` identities
+    per user. A cluster matches an identity when their centroids are within
+    `tolerance`, the least recently matched identity is replaced by a new one.
+    Stored counts are capped at `max_count` faces so attributes keep following
+    new videos.
+    """
+
+    def __init__(self, index_dir: str, max_per_user: int = 32,
+                 tolerance: float = 0.5, max_count: int = 100) -> None:
+        self.index_dir = index_dir
+        self.max_per_user = max_per_user
+        self.tolerance = tolerance
+        self.max_count = max_count
+        self.lock = threading.Lock()
+        os.makedirs(index_dir, exist_ok=True)
+
+    def path(self, userId: int) -> str:
+        return os.path.join(self.index_dir, f"{int(userId)}.npy")
+
+    def open(self, userId: int, dim: int,
+             create: bool = False) -> Optional[np.memmap]:
+        path = self.path(userId)
+        dtype = identity_dtype(dim)
+        if os.path.exists(path):
+            table = np.load(path, mmap_mode='r+')
+            if table.dtype == dtype and table.shape == (self.max_per_user,):
+                return table
+            if not create:
+                return None
+        elif not create:
+            return None
+        # new user, or identities of another encoder or size, start over
+        return np.lib.format.open_memmap(
+            path, mode='w+', dtype=dtype, shape=(self.max_per_user,))
+
+    def match(self, userId: int, centroid: np.ndarray) -> Optional[Identity]:
+        with self.lock:
+            return self.find(userId, centroid)
+
+    def update(
+            self, userId: int, centroid: np.ndarray, gender: float, age: float,
+            skin_tone: float, count: int, slot: int = None) -> None:
+        """
+        Store an identity in `slot`, or in place of the least recently matched
+        one
+        """
+        with self.lock:
+            self.store(userId, centroid, gender, age, skin_tone, count, slot)
+
+    def match_or_update(
+            self, userId: int, centroid: np.ndarray, count: int,
+            attributes: Callable
+    ) -> Tuple[Optional[Identity], Tuple[float, float, float]]:
+        """
+        Blend a cluster of `count` faces into the identity it matches, or store
+        it as a new one, under a single hold of the lock so videos of the same
+        user processed at once never overwrite each other's update.
+
+        :param attributes: gender, age and skin tone of the cluster given the
+            matched identity, None for a new one
+        :return: the matched identity before the update, None for a new one,
+            and the stored attributes
+        """
+        with self.lock:
+            known = self.find(userId, centroid)
+            gender, age, skin_tone = attributes(known)
+            if known is None:
+                self.store(userId, centroid, gender, age, skin_tone, count)
+                return None, (gender, age, skin_tone)
+            gender = blend(known.gender, known.count, gender, count)
+            age = blend(known.age, known.count, age, count)
+            skin_tone = blend(known.skin_tone, known.count, skin_tone, count)
+            blended = (known.centroid * known.count + centroid * count) \
+                / (known.count + count)
+            self.store(userId, blended, gender, age, skin_tone,
+                       known.count + count, known.slot)
+            return known, (gender, age, skin_tone)
+
+    def find(self, userId: int, centroid: np.ndarray) -> Optional[Identity]:
+        table = self.open(userId, len(centroid))
+        if table is None:
+            return None
+        used = table['count'] > 0
+        if not used.any():
+            return None
+        distances = np.linalg.norm(table['centroid'] - centroid, axis=1)
+        distances[~used] = np.inf
+        slot = int(np.argmin(distances))
+        if distances[slot] > self.tolerance:
+            return None
+        row = table[slot]
+        return Identity(slot, np.array(row['centroid']), float(row['gender']),
+                        float(row['age']), float(row['skin_tone']),
+                        int(row['count']))
+
+    def store(
+            self, userId: int, centroid: np.ndarray, gender: float, age: float,
+            skin_tone: float, count: int, slot: int = None) -> None:
+        table = self.open(userId, len(centroid), create=True)
+        if slot is None:
+            slot = int(np.argmin(table['last_used']))
+        table[slot] = (
+            centroid, gender, age, skin_tone, min(count, self.max_count),
+            time.time())
+        table.flush()
+
+    def for_user(self, userId: int) -> 'UserIdentities':
+        return UserIdentities(self, userId)
+
+
+class UserIdentities():
+    """
+    The identities of one user, as passed down to `aggregate_cluster_info`
+    """
+
+    def __init__(self, index: IdentityIndex, userId: int) -> None:
+        self.index = index
+        self.userId = userId
+
+    def match(self, centroid: np.ndarray) -> Optional[Identity]:
+        return self.index.match(self.userId, centroid)
+
+    def update(self, centroid: np.ndarray, gender: float, age: float,
+               skin_tone: float, count: int, slot: int = None) -> None:
+        self.index.update(
+            self.userId, centroid, gender, age, skin_tone, count, slot)
+
+    def match_or_update(
+            self, centroid: np.ndarray, count: int, attributes: Callable
+    ) -> Tuple[Optional[Identity], Tuple[float, float, float]]:
+        return self.index.match_or_update(
+            self.userId, centroid, count, attributes)
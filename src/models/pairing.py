@@ -0,0 +1,69 @@
+import numpy as np
+from typing import Tuple
+
+
+def location_centers(locations) -> np.ndarray:
+    """
+    (x, y) centers of 'face_recognition' (top, right, bottom, left) locations
+    """
+    locations = np.asarray(locations, dtype=np.float32).reshape(-1, 4)
+    return np.stack([(locations[:, 1] + locations[:, 3]) / 2,
+                     (locations[:, 0] + locations[:, 2]) / 2], axis=1)
+
+
+def bbox_centers(bboxes) -> np.ndarray:
+    """
+    (x, y) centers of insightface (x1, y1, x2, y2) boxes
+    """
+    bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+    return np.stack([(bboxes[:, 0] + bboxes[:, 2]) / 2,
+                     (bboxes[:, 1] + bboxes[:, 3]) / 2], axis=1)
+
+
+def pair_detections(locations, bboxes, one_to_one: bool = False,
+                    max_distance: float = None
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pair 'face_recognition' locations with insightface boxes of the same image
+    by nearest center
+
+    :param locations: (n, 4) (top, right, bottom, left) locations
+    :param bboxes: (m, 4) (x1, y1, x2, y2) boxes
+    :param bool one_to_one: every box is paired with at most one location,
+        closest pairs first
+    :param float max_distance: pairs with centers further apart are dropped
+    :return: indices into `locations` and the indices of their paired `bboxes`
+    """
+    empty = np.empty(0, dtype=np.intp)
+    if len(locations) == 0 or len(bboxes) == 0:
+        return empty, empty
+
+    diff = location_centers(locations)[:, None, :] \
+        - bbox_centers(bboxes)[None, :, :]
+    dist = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+
+    if one_to_one:
+        # greedy assignment over all pairs sorted by distance
+        order = np.argsort(dist, axis=None, kind='stable')
+        loc_idx, det_idx = np.unravel_index(order, dist.shape)
+        used_loc = np.zeros(dist.shape[0], dtype=bool)
+        used_det = np.zeros(dist.shape[1], dtype=bool)
+        pairs = []
+        for i, j in zip(loc_idx, det_idx):
+            if used_loc[i] or used_det[j]:
+                continue
+            used_loc[i] = used_det[j] = True
+            pairs.append((i, j))
+            if len(pairs) == min(dist.shape):
+                break
+        pairs.sort()
+        loc_idx = np.array([i for i, _ in pairs], dtype=np.intp)
+        det_idx = np.array([j for _, j in pairs], dtype=np.intp)
+    else:
+        loc_idx = np.arange(dist.shape[0])
+        det_idx = np.argmin(dist, axis=1)
+
+    if max_distance is not None:
+        keep = dist[loc_idx, det_idx] <= max_distance
+        loc_idx, det_idx = loc_idx[keep], det_idx[keep]
+    return loc_idx, det_idx
@@ -0,0 +1,238 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import List
+
+import numpy as np
+
+from src.utils import metrics
+
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS')
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# state of a pool worker process
+worker_extraction = None
+
+
+def limit_session_threads(feature_extraction, threads: int) -> None:
+    """
+    Recreate the onnxruntime sessions of the insightface models with `threads`
+    intra-op threads
+    """
+    models = getattr(feature_extraction.face_analysis, 'models', {})
+    for model in models.values():
+        session = getattr(model, 'session', None)
+        model_file = getattr(model, 'model_file', None)
+        if session is None or model_file is None \
+                or not hasattr(session, 'get_providers'):
+            continue
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        model.session = onnxruntime.InferenceSession(
+            model_file, sess_options=options,
+            providers=session.get_providers())
+
+
+def init_worker(counter, ready_counter, cores_per_worker: int, threads: int,
+                feature_kwargs: dict) -> None:
+    global worker_extraction
+    import cv2
+    from src.models.features import FeatureExtraction
+
+    with counter.get_lock():
+        worker_index = counter.value
+        counter.value += 1
+    if hasattr(os, 'sched_setaffinity'):
+        available = sorted(os.sched_getaffinity(0))
+        start = (worker_index * cores_per_worker) % len(available)
+        cores = available[start:start+cores_per_worker] or available
+        os.sched_setaffinity(0, cores)
+    cv2.setNumThreads(threads)
+
+    worker_extraction = FeatureExtraction(lazy=True, **feature_kwargs)
+    worker_extraction.load()
+    limit_session_threads(worker_extraction, threads)
+    worker_extraction.warm_up()
+    with ready_counter.get_lock():
+        ready_counter.value += 1
+
+
+def process_merged_frame(path: str, shape: tuple, dtype: str, prescaled: bool,
+                         cell_weights: np.ndarray = None):
+    """
+    Raw info of a merged frame handed over through a shared memory file
+    """
+    merged_frame = np.memmap(path, dtype=dtype, mode='r', shape=shape)
+    faces_details, locations, encodings, skin_tones, face_weights = \
+        worker_extraction.get_merged_frame_raw_info(
+            np.asarray(merged_frame), prescaled, cell_weights)
+    faces_details = [{'bbox': np.asarray(d['bbox']), 'gender': d['gender'],
+                      'age': d['age']} for d in faces_details]
+    del merged_frame
+    encodings = [np.asarray(e, dtype=np.float32) for e in encodings]
+    return faces_details, locations, encodings, skin_tones, face_weights
+
+
+def probe_merged_frame(path: str, shape: tuple, dtype: str):
+    """
+    Face locations of a merged frame handed over through a shared memory file
+    """
+    merged_frame = np.memmap(path, dtype=dtype, mode='r', shape=shape)
+    locations = worker_extraction.detect_locations(np.asarray(merged_frame))
+    del merged_frame
+    return locations
+
+
+class ProcessPoolFeatureExtraction:
+    """
+    Runs detection and encoding of merged frames on a pool of processes, each
+    pinned to its share of cores with onnxruntime, OpenCV and BLAS limited to
+    as many threads. Merged frames are passed through files in shared memory
+    instead of being pickled. Clustering and aggregation stay in this process.
+    """
+
+    def __init__(self, workers: int, threads_per_worker: int = None,
+                 lazy: bool = False, **feature_kwargs) -> None:
+        from src.models.features import FeatureExtraction
+        cpu_count = len(os.sched_getaffinity(0)) \
+            if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        self.workers = workers
+        self.threads = threads_per_worker or max(cpu_count // workers, 1)
+        self.feature_kwargs = feature_kwargs
+        # never loads models, only clusters and aggregates
+        self.feature_extraction = FeatureExtraction(
+            lazy=True, **feature_kwargs)
+        self.pool = None
+        self.load_lock = threading.Lock()
+        self.ready = threading.Event()
+        if not lazy:
+            self.load()
+
+    def load(self) -> None:
+        with self.load_lock:
+            if self.pool is not None:
+                return
+            ctx = multiprocessing.get_context('spawn')
+            # thread limits must be in the environment before the workers
+            # import numpy
+            saved = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+            os.environ.update(
+                {var: str(self.threads) for var in THREAD_ENV_VARS})
+            try:
+                self.ready_counter = ctx.Value('i', 0)
+                self.pool = ctx.Pool(
+                    self.workers, initializer=init_worker, initargs=(
+                        ctx.Value('i', 0), self.ready_counter, self.threads,
+                        self.threads, self.feature_kwargs))
+            finally:
+                for var, value in saved.items():
+                    if value is None:
+                        os.environ.pop(var, None)
+                    else:
+                        os.environ[var] = value
+
+    def warm_up(self, poll_seconds: float = 0.5) -> None:
+        """
+        Start the workers and wait until all of them loaded and warmed up their
+        models
+        """
+        self.load()
+        while self.ready_counter.value < self.workers:
+            time.sleep(poll_seconds)
+        self.ready.set()
+
+    @staticmethod
+    def share(merged_frame: np.ndarray) -> str:
+        """
+        Copy a merged frame to a file in shared memory
+        """
+        shm = tempfile.NamedTemporaryFile(
+            dir=SHM_DIR, suffix='.frame', delete=False)
+        shm.close()
+        shared = np.memmap(
+            shm.name, dtype=merged_frame.dtype, mode='w+',
+            shape=merged_frame.shape)
+        shared[...] = merged_frame
+        shared.flush()
+        del shared
+        return shm.name
+
+    def submit(self, merged_frame: np.ndarray, prescaled: bool,
+               cell_weights: np.ndarray = None):
+        path = self.share(merged_frame)
+        result = self.pool.apply_async(process_merged_frame, (
+            path, merged_frame.shape, merged_frame.dtype.str, prescaled,
+            cell_weights))
+        return path, result
+
+    def detect_locations(self, merged_frame: np.ndarray):
+        path = self.share(merged_frame)
+        try:
+            return self.pool.apply(
+                probe_merged_frame,
+                (path, merged_frame.shape, merged_frame.dtype.str))
+        finally:
+            os.remove(path)
+
+    def find_face_timestamps(self, frames, col_count: int = 10,
+                             row_count: int = 4) -> List[float]:
+        from src.models.features import find_face_timestamps
+        self.load()
+        return find_face_timestamps(
+            frames, self.detect_locations, col_count, row_count)
+
+    def collect(self, pending: deque, raw_info: List[list]) -> None:
+        path, result = pending.popleft()
+        try:
+            with metrics.stage('pool_inference'):
+                _raw_info = result.get()
+        finally:
+            os.remove(path)
+        metrics.inc('faces_detected', len(_raw_info[1]))
+        for info, items in zip(raw_info, _raw_info):
+            info += items
+
+    def get_features(self, merged_frames_list: List[np.ndarray],
+                     prescaled: bool = False, weights=None, identities=None):
+        self.load()
+        raw_info = [[], [], [], [], []]
+        pending = deque()
+        try:
+            for merged_index, merged_frame in enumerate(merged_frames_list):
+                cell_weights = weights[merged_index] \
+                    if weights is not None else None
+                pending.append(
+                    self.submit(merged_frame, prescaled, cell_weights))
+                # keep every worker busy while bounding the frames held in
+                # shared memory
+                while len(pending) >= 2*self.workers:
+                    self.collect(pending, raw_info)
+            while pending:
+                self.collect(pending, raw_info)
+        finally:
+            for path, _ in pending:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        faces_details, locations, encodings, skin_tones, face_weights = \
+            raw_info
+        if len(locations) > 0 and len(faces_details) > 0:
+            merged_info = self.feature_extraction.merge_info(
+                faces_details, locations, encodings, skin_tones, face_weights)
+            return self.feature_extraction.get_clusters_features(
+                merged_info, identities)
+        else:
+            return False, None
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -1,12 +1,14 @@
 import cv2
 import numpy as np
-from typing import Tuple
+from typing import Tuple, List
 
 
 class SkinToneDetection():
     """
     Class to detect skin tone in an image.
     """
+    OPEN_KERNEL = np.ones((3, 3), np.uint8)
+    DENOISE_KERNEL = np.ones((4, 4), np.uint8)
 
     def filter_face(self, img: np.ndarray) -> np.ndarray:
         # converting from gbr to hsv color space
@@ -14,20 +16,20 @@ class SkinToneDetection():
         # skin color range for hsv color space
         HSV_mask = cv2.inRange(img_HSV, (0, 10, 40), (255, 210, 255))
         HSV_mask = cv2.morphologyEx(
-            HSV_mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+            HSV_mask, cv2.MORPH_OPEN, self.OPEN_KERNEL)
 
         # converting from gbr to YCbCr color space
         img_YCrCb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
         # skin color range for hsv color space
         YCrCb_mask = cv2.inRange(img_YCrCb, (40, 120, 60), (240, 180, 140))
         YCrCb_mask = cv2.morphologyEx(
-            YCrCb_mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+            YCrCb_mask, cv2.MORPH_OPEN, self.OPEN_KERNEL)
 
         # find common part of skin detection (YCbCr and hsv)
         global_mask = cv2.bitwise_and(YCrCb_mask, HSV_mask)
         global_mask = cv2.medianBlur(global_mask, 3)
         global_mask = cv2.morphologyEx(
-            global_mask, cv2.MORPH_OPEN, np.ones((4, 4), np.uint8))
+            global_mask, cv2.MORPH_OPEN, self.DENOISE_KERNEL)
         frame_denoised = cv2.bitwise_and(img, img, mask=global_mask)
         return frame_denoised
 
@@ -122,3 +124,73 @@ class SkinToneDetection():
         is_skin, skin_tone = self.lab2skintone(l, a, b)
 
         return is_skin, skin_tone
+
+    def rgb2lab_batch(self, rgb: np.ndarray) -> np.ndarray:
+        """
+        Vectorized `rgb2lab` over a (n, 3) array of RGB colours
+        """
+        rgb = np.asarray(rgb, dtype=np.float64) / 255
+        rgb = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4,
+                       rgb / 12.92) * 100
+
+        xyz = np.round(rgb @ np.array([[0.4124, 0.2126, 0.0193],
+                                       [0.3576, 0.7152, 0.1192],
+                                       [0.1805, 0.0722, 0.9505]]), 4)
+        # Observer= 2°, Illuminant= D65
+        xyz = xyz / np.array([95.047, 100.0, 108.883])
+        xyz = np.where(
+            xyz > 0.008856, xyz ** (0.3333333333333333),
+            (7.787 * xyz) + (16 / 116))
+
+        lab = np.stack([(116 * xyz[:, 1]) - 16,
+                        500 * (xyz[:, 0] - xyz[:, 1]),
+                        200 * (xyz[:, 1] - xyz[:, 2])], axis=1)
+        return np.round(lab, 4)
+
+    def lab2skintone_batch(self, lab: np.ndarray) -> np.ndarray:
+        """
+        Vectorized `lab2skintone` over a (n, 3) array of Lab colours
+        """
+        l, a, b = lab[:, 0], lab[:, 1], lab[:, 2]
+        return np.select(
+            [l < 45,
+             (l < 55) & (a > 9) & (b > 6) & (b < 20),
+             l < 55,
+             (l > 65) & (a < 15) & (b < 18) & (b > 1),
+             (l > 65) & (a > 20) & (b > 25),
+             l > 65,
+             (a < 15) & (b > 13) & (b < 20)],
+            [1, 3, 2, 8, 6, 5, 7], default=4).astype(np.float64)
+
+    def imgs2skintone(self, face_imgs: List[np.ndarray],
+                      sample: int = None) -> np.ndarray:
+        """
+        Skin tone of many face crops at once
+
+        :param face_imgs: list of face crops
+        :param int sample: only score this many evenly spaced crops
+        :return: skin tone per scored crop, nan where the crop has too little
+            skin
+        """
+        if sample and len(face_imgs) > sample:
+            face_imgs = [face_imgs[i] for i in np.linspace(
+                0, len(face_imgs) - 1, sample).astype(int)]
+
+        rgb_means = np.full((len(face_imgs), 3), np.nan)
+        for i, face_img in enumerate(face_imgs):
+            if face_img.size == 0:
+                continue
+            pixels = self.filter_face(face_img).reshape(-1, 3)
+            counts = np.count_nonzero(pixels, axis=0)
+            if (counts[2] / len(pixels))*100 < 30:  # information threshold
+                continue
+            with np.errstate(invalid='ignore', divide='ignore'):
+                # bgr -> rgb
+                rgb_means[i] = (pixels.sum(axis=0) / counts)[::-1]
+
+        valid = ~np.isnan(rgb_means).any(axis=1)
+        skin_tones = np.full(len(face_imgs), np.nan)
+        if valid.any():
+            skin_tones[valid] = self.lab2skintone_batch(
+                self.rgb2lab_batch(rgb_means[valid]))
+        return skin_tones
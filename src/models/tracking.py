@@ -0,0 +1,146 @@
+import numpy as np
+from typing import List
+
+
+def location_ious(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    (n, m) intersection over union of 'face_recognition' (top, right, bottom,
+    left) locations
+    """
+    top = np.maximum(a[:, None, 0], b[None, :, 0])
+    right = np.minimum(a[:, None, 1], b[None, :, 1])
+    bottom = np.minimum(a[:, None, 2], b[None, :, 2])
+    left = np.maximum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    area_a = (a[:, 1] - a[:, 3]) * (a[:, 2] - a[:, 0])
+    area_b = (b[:, 1] - b[:, 3]) * (b[:, 2] - b[:, 0])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+class FaceTracker:
+    """
+    Links faces of consecutive sampled frames into tracks by IoU, falling back
+    to the distance between centers. Only a few faces per track become entries
+    (to be encoded and scored), every other face adds its weight to the last
+    entry of its track and counts as one more face of it.
+    """
+
+    def __init__(self, iou_threshold: float = 0.3,
+                 max_center_distance: float = 0.5, max_gap: int = 1,
+                 samples: int = 3, sample_every: int = 10) -> None:
+        """
+        :param float iou_threshold: minimum IoU to continue a track
+        :param float max_center_distance: maximum distance between centers,
+            relative to the track's face size
+        :param int max_gap: sampled frames in a row a track can miss before it
+            ends
+        :param int samples: maximum entries per track
+        :param int sample_every: faces of a track between two of its entries
+        """
+        self.iou_threshold = iou_threshold
+        self.max_center_distance = max_center_distance
+        self.max_gap = max_gap
+        self.samples = samples
+        self.sample_every = sample_every
+        # state of the live tracks
+        self.boxes = np.empty((0, 4), dtype=np.float32)
+        self.last_frame = np.empty(0, dtype=np.int64)
+        self.entry = np.empty(0, dtype=np.int64)
+        self.entry_count = np.empty(0, dtype=np.int64)
+        self.since_entry = np.empty(0, dtype=np.int64)
+        # weight and faces of every entry, in the order entries were created
+        self.weights = []
+        self.counts = []
+
+    def match(self, locations: np.ndarray) -> np.ndarray:
+        """
+        Track index of every location, -1 for new faces
+        """
+        matches = np.full(len(locations), -1, dtype=np.int64)
+        if len(self.boxes) == 0 or len(locations) == 0:
+            return matches
+        ious = location_ious(locations, self.boxes)
+        centers = np.stack([(locations[:, 1] + locations[:, 3]) / 2,
+                            (locations[:, 0] + locations[:, 2]) / 2], axis=1)
+        track_centers = np.stack([(self.boxes[:, 1] + self.boxes[:, 3]) / 2,
+                                  (self.boxes[:, 0] + self.boxes[:, 2]) / 2],
+                                 axis=1)
+        track_sizes = np.sqrt((self.boxes[:, 1] - self.boxes[:, 3])
+                              * (self.boxes[:, 2] - self.boxes[:, 0]))
+        distances = np.linalg.norm(
+            centers[:, None, :] - track_centers[None, :, :], axis=2) \
+            / np.maximum(track_sizes[None, :], 1)
+
+        # greedy assignment, overlapping pairs first then close pairs
+        closeness = 1 - distances / (self.max_center_distance + 1e-6)
+        score = np.where(ious >= self.iou_threshold, 2 + ious,
+                         np.where(distances <= self.max_center_distance,
+                                  closeness, -1))
+        used = np.zeros(len(self.boxes), dtype=bool)
+        for flat in np.argsort(-score, axis=None, kind='stable'):
+            i, j = np.unravel_index(flat, score.shape)
+            if score[i, j] < 0:
+                break
+            if matches[i] >= 0 or used[j]:
+                continue
+            matches[i] = j
+            used[j] = True
+        return matches
+
+    def update(self, frame_index: int, locations,
+               weights: List[int]) -> np.ndarray:
+        """
+        Add the faces of one sampled frame
+
+        :param int frame_index: index of the frame, increasing between calls
+        :param locations: (n, 4) (top, right, bottom, left) locations of the
+            faces of the frame
+        :param weights: number of sampled frames each face stands for
+        :return: (n,) bool mask of the faces that became entries
+        """
+        # a track last seen `max_gap` + 1 frames ago only missed `max_gap` of
+        # them
+        alive = frame_index - self.last_frame <= self.max_gap + 1
+        self.boxes, self.last_frame = self.boxes[alive], self.last_frame[alive]
+        self.entry, self.entry_count, self.since_entry = \
+            self.entry[alive], self.entry_count[alive], self.since_entry[alive]
+
+        locations = np.asarray(locations, dtype=np.float32).reshape(-1, 4)
+        matches = self.match(locations)
+        is_entry = np.zeros(len(locations), dtype=bool)
+        new_tracks = []
+        for i, track in enumerate(matches):
+            if track < 0:
+                is_entry[i] = True
+                new_tracks.append((locations[i], len(self.weights)))
+                self.weights.append(int(weights[i]))
+                self.counts.append(1)
+                continue
+            self.boxes[track] = locations[i]
+            self.last_frame[track] = frame_index
+            self.since_entry[track] += 1
+            if self.entry_count[track] < self.samples \
+                    and self.since_entry[track] >= self.sample_every:
+                is_entry[i] = True
+                self.entry[track] = len(self.weights)
+                self.entry_count[track] += 1
+                self.since_entry[track] = 0
+                self.weights.append(int(weights[i]))
+                self.counts.append(1)
+            else:
+                self.weights[self.entry[track]] += int(weights[i])
+                self.counts[self.entry[track]] += 1
+
+        if new_tracks:
+            self.boxes = np.concatenate(
+                [self.boxes, np.stack([box for box, _ in new_tracks])])
+            self.last_frame = np.concatenate(
+                [self.last_frame, np.full(len(new_tracks), frame_index)])
+            self.entry = np.concatenate(
+                [self.entry, [entry for _, entry in new_tracks]]
+            ).astype(np.int64)
+            self.entry_count = np.concatenate(
+                [self.entry_count, np.ones(len(new_tracks), dtype=np.int64)])
+            self.since_entry = np.concatenate(
+                [self.since_entry, np.zeros(len(new_tracks), dtype=np.int64)])
+        return is_entry
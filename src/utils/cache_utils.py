@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Optional
+
+import requests
+
+from src.utils import metrics
+from src.utils.utils import to_json
+
+
+def video_fingerprint(url: str, timeout: float = 5) -> Optional[str]:
+    """
+    Identity of a video's content: hash of a local file, or ETag and size of an
+    S3 object
+    """
+    if os.path.exists(url):
+        sha1 = hashlib.sha1()
+        with open(url, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                sha1.update(chunk)
+        return f"sha1:{sha1.hexdigest()}"
+    try:
+        response = requests.head(url, timeout=timeout)
+        response.raise_for_status()
+    except requests.RequestException:
+        return None
+    etag = response.headers.get('ETag')
+    size = response.headers.get('Content-Length')
+    if not etag or not size:
+        return None
+    etag = etag.strip('"')
+    return f"etag:{etag}:{size}"
+
+
+class ResultCache():
+    """
+    On-disk cache of video results keyed by content fingerprint and model
+    version, one JSON file per entry. Entries older than `ttl` seconds are
+    dropped, the least recently used ones once the cache exceeds `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: str, model_version: str, max_bytes: int,
+                 ttl: float) -> None:
+        self.cache_dir = cache_dir
+        self.model_version = model_version
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(os.path.getsize(os.path.join(cache_dir, name))
+                        for name in os.listdir(cache_dir)
+                        if name.endswith('.json'))
+
+    def path(self, fingerprint: str) -> str:
+        key = hashlib.sha1(f"{self.model_version}:{fingerprint}"
+                           .encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, fingerprint: str) -> Optional[dict]:
+        path = self.path(fingerprint)
+        with self.lock:
+            try:
+                stat = os.stat(path)
+                if time.time() - stat.st_mtime > self.ttl:
+                    self.remove(path, stat.st_size)
+                    value = None
+                else:
+                    with open(path) as f:
+                        value = json.load(f)
+                    os.utime(path)  # most recently used
+            except (OSError, ValueError):
+                value = None
+        metrics.RESULT_CACHE.inc(
+            outcome='hit' if value is not None else 'miss')
+        return value
+
+    def put(self, fingerprint: str, value: dict) -> None:
+        path = self.path(fingerprint)
+        data = json.dumps(value, default=to_json)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        with self.lock:
+            if os.path.exists(path):
+                self.size -= os.path.getsize(path)
+            os.replace(tmp_path, path)
+            self.size += len(data.encode('utf-8'))
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def remove(self, path: str, size: int) -> None:
+        try:
+            os.remove(path)
+            self.size -= size
+        except OSError:
+            pass
+
+    def evict(self) -> None:
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((
+                    stat.st_mtime, stat.st_size,
+                    os.path.join(self.cache_dir, name)))
+        for mtime, size, path in sorted(entries):
+            if self.size <= self.max_bytes and now - mtime <= self.ttl:
+                break
+            self.remove(path, size)
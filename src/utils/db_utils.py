@@ -1,62 +1,323 @@
-import os
-import MySQL
+import atexit
 import json
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Any, List, Tuple
+
 from consts import Status, MySQLConsts, ModelConsts
+from src.utils.utils import logger
+
+try:
+    import pymysql
+except ImportError:  # only the legacy MySQL module is available
+    pymysql = None
+
+ESCAPES = {
+    '\0': '\\0', '\n': '\\n', '\r': '\\r', '\x1a': '\\Z', "'": "\\'",
+    '"': '\\"', '\\': '\\\\'}
+
+
+def literal(value: Any) -> str:
+    """
+    SQL literal of a parameter, for the legacy module that only takes full
+    statements
+    """
+    if hasattr(value, 'item'):  # numpy scalars
+        value = value.item()
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + ''.join(ESCAPES.get(c, c) for c in str(value)) + "'"
+
+
+def plain(params: tuple) -> tuple:
+    # numpy scalars are not known to the driver
+    return tuple(
+        param.item() if hasattr(param, 'item') else param for param in params)
+
+
+def interpolate(sql: str, params: tuple) -> str:
+    return sql % tuple(literal(param) for param in params)
+
+
+class ConnectionPool():
+    """
+    At most `size` autocommit pymysql connections, reused across threads
+    """
+
+    def __init__(self, size: int, **connect_kwargs) -> None:
+        self.connect_kwargs = connect_kwargs
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+                connection.ping(reconnect=True)
+            except queue.Empty:
+                connection = pymysql.connect(
+                    autocommit=True, **self.connect_kwargs)
+            except pymysql.MySQLError:
+                connection = pymysql.connect(
+                    autocommit=True, **self.connect_kwargs)
+            try:
+                yield connection
+            except Exception:
+                connection.close()
+                raise
+            self.idle.put(connection)
+
+
+class Database():
+    """
+    Parameterized statements (`%s` placeholders) on a connection pool, or on
+    the legacy MySQL module with escaped parameters when no pool is configured
+    """
+
+    def __init__(self, pool: ConnectionPool = None) -> None:
+        self.pool = pool
+
+    def execute(self, sql: str, params: tuple = ()) -> None:
+        if self.pool is None:
+            import MySQL
+            MySQL.execute_query_in_prod(interpolate(sql, params))
+            return
+        with self.pool.connection() as connection, \
+                connection.cursor() as cursor:
+            cursor.execute(sql, plain(params))
+
+    def fetch_rows(self, sql: str, params: tuple = ()) -> List[tuple]:
+        if self.pool is None:
+            import MySQL
+            data = MySQL.get_prod_data(interpolate(sql, params))
+            return list(data.itertuples(index=False, name=None))
+        with self.pool.connection() as connection, \
+                connection.cursor() as cursor:
+            cursor.execute(sql, plain(params))
+            return list(cursor.fetchall())
+
+    def fetch_scalar(self, sql: str, params: tuple = ()) -> Any:
+        """
+        First column of the first row, None without rows
+        """
+        rows = self.fetch_rows(sql, params)
+        return rows[0][0] if len(rows) > 0 else None
+
+
+class WriteBehindBatcher():
+    """
+    Queues status and result writes and flushes them from a background thread
+    every `flush_seconds` or `batch_size` writes. Consecutive writes of the
+    same kind are coalesced into one multi-row statement, in queue order.
+    Writes only queued are lost if the process is killed, `wait` blocks until
+    those of a geoChatId are flushed.
+    """
+
+    def __init__(self, database: Database, batch_size: int = 50,
+                 flush_seconds: float = 1.0) -> None:
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.condition = threading.Condition()
+        self.writes = []  # (kind, key, geoChatId, values)
+        self.pending = {}  # geoChatId -> writes not flushed yet
+        self.flush_lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def add(self, kind: str, key, geoChatId: int, values: tuple) -> None:
+        with self.condition:
+            self.writes.append((kind, key, geoChatId, values))
+            self.pending[geoChatId] = self.pending.get(geoChatId, 0) + 1
+            if len(self.writes) >= self.batch_size:
+                self.condition.notify()
+
+    def is_pending(self, geoChatId: int) -> bool:
+        with self.condition:
+            return geoChatId in self.pending
+
+    def wait(self, geoChatId: int) -> None:
+        with self.condition:
+            self.condition.wait_for(lambda: geoChatId not in self.pending)
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: len(self.writes) >= self.batch_size,
+                    self.flush_seconds)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Unable to flush database writes, retrying")
+
+    def flush(self) -> None:
+        with self.flush_lock:
+            with self.condition:
+                writes, self.writes = self.writes, []
+            start = 0
+            try:
+                while start < len(writes):
+                    kind, key = writes[start][:2]
+                    end = start
+                    while end < len(writes) and writes[end][:2] == (kind, key):
+                        end += 1
+                    if kind == 'status':
+                        self.flush_statuses(key, writes[start:end])
+                    else:
+                        self.flush_results(key, writes[start:end])
+                    start = end
+            except Exception:
+                with self.condition:
+                    # keep order, unflushed writes go first
+                    self.writes = writes[start:] + self.writes
+                raise
+            finally:
+                with self.condition:
+                    for _, _, geoChatId, _ in writes[:start]:
+                        self.pending[geoChatId] -= 1
+                        if self.pending[geoChatId] == 0:
+                            del self.pending[geoChatId]
+                    self.condition.notify_all()
+
+    def flush_statuses(self, status: str, writes: list) -> None:
+        sql = f"""
+            INSERT INTO {MySQLConsts.LOG_TABLE} (trailId, userId, geoChatId)
+            VALUES {', '.join(['(%s, %s, %s)'] * len(writes))}
+            ON DUPLICATE KEY UPDATE status=%s
+        """
+        self.database.execute(
+            sql,
+            tuple(v for _, _, _, values in writes for v in values) + (status,))
+
+    def flush_results(self, columns: tuple, writes: list) -> None:
+        # the last result of a geoChatId wins, like consecutive updates would
+        rows = {}
+        for _, _, geoChatId, values in writes:
+            rows[geoChatId] = values
+        assignments, params = [], []
+        for index, column in enumerate(columns):
+            cases = ' '.join(['WHEN %s THEN %s'] * len(rows))
+            assignments.append(f"{column} = CASE geoChatId {cases} END")
+            params += [v for geoChatId, values in rows.items()
+                       for v in (geoChatId, values[index])]
+        sql = f"""UPDATE {MySQLConsts.LOG_TABLE}
+                  SET {', '.join(assignments)}
+                  WHERE geoChatId IN ({', '.join(['%s'] * len(rows))})"""
+        self.database.execute(sql, tuple(params) + tuple(rows.keys()))
+
+
+def create_database() -> Database:
+    if not MySQLConsts.HOST or pymysql is None:
+        return Database()
+    return Database(ConnectionPool(
+        MySQLConsts.POOL_SIZE, host=MySQLConsts.HOST, port=MySQLConsts.PORT,
+        user=MySQLConsts.USER, password=MySQLConsts.PASSWORD,
+        database=MySQLConsts.DATABASE, charset='utf8mb4'))
+
+
+database = create_database()
+batcher = WriteBehindBatcher(
+    database, MySQLConsts.WRITE_BATCH_SIZE, MySQLConsts.WRITE_FLUSH_SECONDS
+) if MySQLConsts.WRITE_BEHIND else None
+
 
 class DBUtils():
     @staticmethod
     def update_status(status: str, trailId: int, userId: int, geoChatId: int) -> None:
+        if batcher is not None:
+            batcher.add(
+                'status', status, geoChatId, (trailId, userId, geoChatId))
+            return
         sql = f"""
             INSERT INTO {MySQLConsts.LOG_TABLE} (trailId, userId, geoChatId)
-            VALUES ({trailId}, {userId}, {geoChatId})
-            ON DUPLICATE KEY UPDATE status='{status}'
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE status=%s
         """
-        MySQL.execute_query_in_prod(sql)
+        database.execute(sql, (trailId, userId, geoChatId, status))
 
     @staticmethod
-    def update_trail_info(geoChatId: int, status: str, has_faces: bool, people: list, modelVersion: str = ModelConsts.MODEL_VERSION) -> None:
-        has_faces = 1 if has_faces else 0
-        
-        sql =   f"""UPDATE {MySQLConsts.LOG_TABLE}
-                    SET 
-                    status='{status}',
-                    modelVersion= '{modelVersion}',
-                    hasFaces= {has_faces},
-                    peopleCount= {len(people)},
-                    peopleJson= '{json.dumps(people)}',"""
+    def trail_info_columns(status: str, has_faces: bool, people: list,
+                           modelVersion: str) -> Tuple[tuple, tuple]:
+        columns = {
+            'status': status,
+            'modelVersion': modelVersion,
+            'hasFaces': 1 if has_faces else 0,
+            'peopleCount': len(people),
+            'peopleJson': json.dumps(people)}
         if has_faces:
-            sql +=  f"""primaryGender= {people[0]['gender']},
-                        primaryAge= {people[0]['age']},
-                        primaryPersonDuration= {people[0]['duration']},"""
+            columns.update({
+                'primaryGender': people[0]['gender'],
+                'primaryAge': people[0]['age'],
+                'primaryPersonDuration': people[0]['duration']})
             if people[0]['skin_tone_score'] != None:
-                sql += f"""primarySkinToneScore= {people[0]['skin_tone_score']},
-                           primarySkinTone= '{people[0]['skin_tone']}',"""
-        # remove last comma
-        sql = sql.rstrip(',') + ' WHERE geoChatId=' + str(geoChatId)
-        MySQL.execute_query_in_prod(sql)
+                columns.update({
+                    'primarySkinToneScore': people[0]['skin_tone_score'],
+                    'primarySkinTone': people[0]['skin_tone']})
+        return tuple(columns.keys()), tuple(columns.values())
+
+    @staticmethod
+    def update_trail_info(geoChatId: int, status: str, has_faces: bool, people: list, modelVersion: str = ModelConsts.MODEL_VERSION) -> None:
+        columns, values = DBUtils.trail_info_columns(
+            status, has_faces, people, modelVersion)
+        if batcher is not None:
+            batcher.add('result', columns, geoChatId, values)
+            return
+        sql = f"""UPDATE {MySQLConsts.LOG_TABLE}
+                  SET {', '.join(f'{column}=%s' for column in columns)}
+                  WHERE geoChatId=%s"""
+        database.execute(sql, values + (geoChatId,))
+
+    @staticmethod
+    def wait_for_writes(geoChatId: int) -> None:
+        """
+        Block until the queued writes of `geoChatId` are in the database
+        """
+        if batcher is not None:
+            batcher.wait(geoChatId)
+
+    @staticmethod
+    def flush_writes() -> None:
+        if batcher is not None:
+            batcher.flush()
 
     @staticmethod
     def check_if_already_processed(geoChatId: int) -> bool:
-        statuses = f"'{Status.SUCCESS}','{Status.PICKED}','{Status.FAILED}'"
+        if batcher is not None and batcher.is_pending(geoChatId):
+            return True
         sql = f"""
-            SELECT status 
-            FROM {MySQLConsts.LOG_TABLE} 
-            WHERE geoChatId = {geoChatId} AND status IN ({statuses})
+            SELECT 1
+            FROM {MySQLConsts.LOG_TABLE}
+            WHERE geoChatId = %s AND status IN (%s, %s, %s)
+            LIMIT 1
         """
-        if len(MySQL.get_prod_data(sql)) > 0:
-            return True
-        else:
-            return False
+        return database.fetch_scalar(sql, (
+            geoChatId, Status.SUCCESS, Status.PICKED, Status.FAILED)) \
+            is not None
 
     @staticmethod
-    def get_userId(trailId: int) -> int:
+    def get_processed_geoChatIds() -> List[int]:
         sql = f"""
-            SELECT userId 
-            FROM userTrails 
-            WHERE trailListId = {trailId};
+            SELECT geoChatId
+            FROM {MySQLConsts.LOG_TABLE}
+            WHERE status IN (%s, %s, %s)
+        """
+        return [row[0] for row in database.fetch_rows(
+            sql, (Status.SUCCESS, Status.PICKED, Status.FAILED))]
+
+    @staticmethod
+    def get_userId(trailId: int) -> int:
+        sql = """
+            SELECT userId
+            FROM userTrails
+            WHERE trailListId = %s
+            LIMIT 1
             """
-        data = MySQL.get_prod_data(sql)
-        if len(data) > 0:
-            return data.iloc[0].userId
-        else:
-            return -1
+        userId = database.fetch_scalar(sql, (trailId,))
+        return userId if userId is not None else -1
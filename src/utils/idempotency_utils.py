@@ -0,0 +1,137 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable
+
+import numpy as np
+
+from src.utils import metrics
+
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    x = x.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class RecentIds():
+    """
+    Bounded set of ids seen in the last `ttl` seconds, least recently seen
+    dropped first
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.expiries = OrderedDict()
+
+    def add(self, key) -> None:
+        with self.lock:
+            self.expiries[key] = time.time() + self.ttl
+            self.expiries.move_to_end(key)
+            while len(self.expiries) > self.max_size:
+                self.expiries.popitem(last=False)
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            expiry = self.expiries.get(key)
+            if expiry is None:
+                return False
+            if expiry < time.time():
+                del self.expiries[key]
+                return False
+            self.expiries.move_to_end(key)
+            return True
+
+
+class BloomFilter():
+    """
+    Bloom filter of integer ids sized for `capacity` ids at `error_rate` false
+    positives, ids are hashed with numpy so millions can be added at once
+    """
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self.size = max(
+            int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hash_count = max(
+            int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self.lock = threading.Lock()
+
+    def positions(self, keys) -> np.ndarray:
+        h1 = splitmix64(np.asarray(keys, dtype=np.int64).reshape(-1))
+        h2 = splitmix64(h1) | np.uint64(1)
+        steps = np.arange(self.hash_count, dtype=np.uint64)
+        return (h1[:, None] + steps[None, :] * h2[:, None]) \
+            % np.uint64(self.size)
+
+    def add_many(self, keys) -> None:
+        positions = self.positions(keys).reshape(-1)
+        with self.lock:
+            np.bitwise_or.at(
+                self.bits, positions >> np.uint64(3),
+                np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+
+    def __contains__(self, key) -> bool:
+        positions = self.positions([key])[0]
+        bits = self.bits[positions >> np.uint64(3)] \
+            >> (positions & np.uint64(7)).astype(np.uint8)
+        return bool(np.all(bits & 1))
+
+
+class IdempotencyGuard():
+    """
+    Answers whether a geoChatId was already processed, from the ids recently
+    picked by this process and a bloom filter of the log table before asking
+    the database. Bloom filter positives are taken as duplicates, its
+    `error_rate` bounds the new ids wrongly dropped.
+    """
+
+    def __init__(self, check: Callable[[int], bool], recent_size: int,
+                 recent_ttl: float, bloom_capacity: int = 0,
+                 bloom_error_rate: float = 1e-6) -> None:
+        self.check = check
+        self.lock = threading.Lock()
+        self.recent = RecentIds(recent_size, recent_ttl)
+        self.bloom = BloomFilter(bloom_capacity, bloom_error_rate) \
+            if bloom_capacity > 0 else None
+
+    def warm(self, geoChatIds: Iterable[int]) -> None:
+        if self.bloom is not None:
+            self.bloom.add_many(np.fromiter(geoChatIds, dtype=np.int64))
+
+    def is_processed(self, geoChatId) -> bool:
+        if geoChatId in self.recent:
+            outcome = 'recent'
+        elif self.bloom is not None and isinstance(geoChatId, int) \
+                and geoChatId in self.bloom:
+            outcome = 'bloom'
+        elif self.check(geoChatId):
+            self.recent.add(geoChatId)
+            outcome = 'database'
+        else:
+            outcome = 'new'
+        metrics.IDEMPOTENCY_CHECKS.inc(outcome=outcome)
+        return outcome != 'new'
+
+    def claim(self, geoChatId) -> bool:
+        """
+        True if the geoChatId was not processed yet, it is then remembered as
+        picked so concurrent replays of the same message are dropped
+        """
+        with self.lock:
+            if self.is_processed(geoChatId):
+                return False
+            self.add(geoChatId)
+            return True
+
+    def add(self, geoChatId) -> None:
+        """
+        Remember a geoChatId picked for processing
+        """
+        self.recent.add(geoChatId)
+        if self.bloom is not None and isinstance(geoChatId, int):
+            self.bloom.add_many([geoChatId])
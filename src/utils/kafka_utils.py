@@ -0,0 +1,242 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable
+
+from kafka import KafkaConsumer, TopicPartition, ConsumerRebalanceListener
+from kafka.structs import OffsetAndMetadata
+
+
+class OffsetTracker():
+    """
+    Tracks dispatched offsets per partition and only exposes commits up to the
+    highest contiguous completed message.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # TopicPartition -> deque of offsets in dispatch order
+        self.dispatched = {}
+        self.completed = {}  # TopicPartition -> set of completed offsets
+        self.committable = {}  # TopicPartition -> next offset to commit
+
+    def add(self, tp: TopicPartition, offset: int) -> None:
+        with self.lock:
+            self.dispatched.setdefault(tp, deque()).append(offset)
+            self.completed.setdefault(tp, set())
+
+    def complete(self, tp: TopicPartition, offset: int) -> None:
+        with self.lock:
+            if tp not in self.dispatched:
+                return  # partition was revoked while the message was processed
+            self.completed[tp].add(offset)
+            dispatched, completed = self.dispatched[tp], self.completed[tp]
+            while dispatched and dispatched[0] in completed:
+                completed.discard(dispatched[0])
+                self.committable[tp] = dispatched.popleft() + 1
+
+    def pop_commits(self) -> Dict[TopicPartition, OffsetAndMetadata]:
+        with self.lock:
+            commits = {tp: OffsetAndMetadata(offset, None)
+                       for tp, offset in self.committable.items()}
+            self.committable = {}
+        return commits
+
+    def in_flight(self) -> int:
+        with self.lock:
+            return sum(len(offsets) for offsets in self.dispatched.values())
+
+    def revoke(self, partitions: Iterable[TopicPartition]) -> None:
+        with self.lock:
+            for tp in partitions:
+                self.dispatched.pop(tp, None)
+                self.completed.pop(tp, None)
+                self.committable.pop(tp, None)
+
+
+class WorkerPoolConsumer(ConsumerRebalanceListener):
+    """
+    Polls batches of messages and hands each one to `handler` on a pool of
+    worker threads. Partitions are paused while `max_in_flight` messages are
+    being processed, polling continues meanwhile so the consumer never
+    exceeds `max_poll_interval_ms`. `prefetch` is called with every message
+    as soon as it is queued, e.g. to start downloading its video. With
+    `priority`, the estimated seconds of a message, queued messages run in
+    order of their queueing time plus estimate: shorter ones first, without
+    delaying any message by more than its own estimate. Estimates may probe
+    the video, they are computed on their own threads, never while polling.
+    `request_stop` ends `run` once the running messages are done.
+    `initializer` runs once on every worker thread before its first message,
+    `ready` once it ran on all of them.
+    """
+
+    def __init__(self, consumer: KafkaConsumer, handler: Callable,
+                 worker_count: int, max_in_flight: int = None,
+                 poll_timeout_ms: int = 1000, prefetch: Callable = None,
+                 priority: Callable = None, initializer: Callable = None,
+                 ready: Callable = None) -> None:
+        self.consumer = consumer
+        self.handler = handler
+        self.initializer = initializer
+        self.ready = ready
+        self.prefetch = prefetch
+        self.priority = priority
+        # heap of (deadline, sequence, message) waiting for a worker
+        self.queued = []
+        self.queued_lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.worker_count = worker_count
+        self.max_in_flight = max_in_flight or 2*worker_count
+        self.poll_timeout_ms = poll_timeout_ms
+        self.tracker = OffsetTracker()
+        self.finished = queue.Queue()
+        self.futures = set()  # worker tasks not done yet
+        self.paused = False
+        self.stopping = threading.Event()
+
+    def request_stop(self) -> None:
+        """
+        Stop polling, e.g. from a signal handler. Queued messages are dropped,
+        the running ones are finished and committed before `run` returns.
+        """
+        self.stopping.set()
+
+    def on_partitions_revoked(self, revoked):
+        self.commit()
+        self.tracker.revoke(revoked)
+
+    def on_partitions_assigned(self, assigned):
+        self.paused = False
+
+    def commit(self) -> None:
+        commits = self.tracker.pop_commits()
+        if len(commits) > 0:
+            self.consumer.commit(commits)
+
+    def dispatch(self, executor: ThreadPoolExecutor, message,
+                 estimator: ThreadPoolExecutor = None) -> None:
+        tp = TopicPartition(message.topic, message.partition)
+        self.tracker.add(tp, message.offset)
+        if self.prefetch is not None:
+            self.prefetch(message)
+        if self.priority is None:
+            future = executor.submit(self.handler, message)
+            future.add_done_callback(
+                lambda f: f.cancelled() or self.finished.put(
+                    (tp, message.offset, f.exception())))
+        else:
+            future = estimator.submit(self.enqueue, executor, message)
+        self.track(future)
+
+    def track(self, future) -> None:
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+
+    def enqueue(self, executor: ThreadPoolExecutor, message) -> None:
+        try:
+            cost = self.priority(message)
+        except Exception as e:
+            self.finished.put((
+                TopicPartition(message.topic, message.partition),
+                message.offset, e))
+            return
+        with self.queued_lock:
+            heapq.heappush(self.queued, (
+                time.time() + cost, next(self.sequence), message))
+        # every worker task runs the most urgent queued message
+        try:
+            self.track(executor.submit(self.handle_next))
+        except RuntimeError:
+            pass  # stopped, the message is replayed
+
+    def initialize(self, barrier: threading.Barrier) -> None:
+        try:
+            self.initializer()
+        except Exception as e:
+            barrier.abort()
+            self.finished.put((None, None, e))
+            return
+        try:
+            # holds the thread so every worker runs the initializer once
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+
+    def handle_next(self) -> None:
+        with self.queued_lock:
+            if len(self.queued) == 0:
+                return  # dropped by `stop`
+            _, _, message = heapq.heappop(self.queued)
+        error = None
+        try:
+            self.handler(message)
+        except Exception as e:
+            error = e
+        self.finished.put((
+            TopicPartition(message.topic, message.partition), message.offset,
+            error))
+
+    def reap(self) -> None:
+        while True:
+            try:
+                tp, offset, error = self.finished.get_nowait()
+            except queue.Empty:
+                return
+            if error is not None:
+                # leave the offset uncommitted so the message is replayed
+                self.commit()
+                raise error
+            self.tracker.complete(tp, offset)
+
+    def throttle(self) -> None:
+        in_flight = self.tracker.in_flight()
+        if not self.paused and in_flight >= self.max_in_flight:
+            self.consumer.pause(*self.consumer.assignment())
+            self.paused = True
+        elif self.paused and in_flight < self.max_in_flight:
+            self.consumer.resume(*self.consumer.paused())
+            self.paused = False
+
+    def stop(self, executor: ThreadPoolExecutor,
+             estimator: ThreadPoolExecutor = None, wait: bool = False) -> None:
+        """
+        Drop the messages no worker started yet, they are uncommitted and
+        replayed, and return without waiting for the running ones unless `wait`
+        """
+        if estimator is not None:
+            estimator.shutdown(wait=False)
+        executor.shutdown(wait=False)
+        with self.queued_lock:
+            self.queued = []
+        for future in list(self.futures):
+            future.cancel()
+        if wait:
+            executor.shutdown(wait=True)
+
+    def run(self) -> None:
+        executor = ThreadPoolExecutor(max_workers=self.worker_count)
+        estimator = ThreadPoolExecutor(max_workers=self.worker_count) \
+            if self.priority is not None else None
+        if self.initializer is not None:
+            # queued before any message
+            barrier = threading.Barrier(self.worker_count, action=self.ready)
+            for _ in range(self.worker_count):
+                self.track(executor.submit(self.initialize, barrier))
+        try:
+            while not self.stopping.is_set():
+                records = self.consumer.poll(timeout_ms=self.poll_timeout_ms)
+                for messages in records.values():
+                    for message in messages:
+                        self.dispatch(executor, message, estimator)
+                self.reap()
+                self.commit()
+                self.throttle()
+        finally:
+            self.stop(executor, estimator, wait=self.stopping.is_set())
+        # stopped on request, the messages finished meanwhile are committed
+        self.reap()
+        self.commit()
@@ -0,0 +1,60 @@
+import json
+from typing import NamedTuple, Optional
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:  # the standard parser is only slower
+    loads = json.loads
+
+from src.utils.utils import logger
+
+SERVE_READY = 'serve-ready'
+SERVE_READY_BYTES = SERVE_READY.encode('utf-8')
+
+
+class Transaction(NamedTuple):
+    trailId: Optional[int]
+    geoChatId: Optional[int]
+    geoChatVideo: Optional[str]
+    userId: Optional[int]
+
+
+def as_int(value) -> Optional[int]:
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lstrip('-').isdigit():
+        return int(value)
+    return None
+
+
+def to_transaction(data) -> Optional[Transaction]:
+    """
+    Transaction of the `data` of a serve-ready event, None when it is not an
+    object
+    """
+    if not isinstance(data, dict):
+        return None
+    geoChatVideo = data.get('geoChatVideo')
+    return Transaction(
+        trailId=as_int(data.get('trailId')),
+        geoChatId=as_int(data.get('geoChatId')),
+        geoChatVideo=geoChatVideo if isinstance(geoChatVideo, str) else None,
+        userId=as_int(data.get('userId')))
+
+
+def decode_transaction(value: Optional[bytes]) -> Optional[Transaction]:
+    """
+    Kafka value deserializer keeping only serve-ready events. Payloads that
+    cannot be one are skipped without being parsed.
+    """
+    if value is None or SERVE_READY_BYTES not in value:
+        return None
+    try:
+        event = loads(value)
+    except ValueError:
+        logger.exception('Unable to decode: %s', value[:200])
+        return None
+    if not isinstance(event, dict) or event.get('type') != SERVE_READY:
+        return None
+    return to_transaction(event.get('data'))
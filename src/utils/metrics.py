@@ -0,0 +1,263 @@
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from typing import Iterable, Iterator, Tuple
+
+# seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if len(labels) == 0:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"')
+               .replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"'
+                          for (k, _), v in zip(labels, escaped)) + '}'
+
+
+class Metric():
+    """
+    Thread-safe metric rendered in Prometheus text format
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def header(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+    def render(self) -> Iterator[str]:
+        yield from self.header()
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            yield f"{self.name}{format_labels(labels)} {value}"
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total, count = self.values.get(
+                key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (value <= b) for c, b in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self) -> Iterator[str]:
+        yield from self.header()
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, (counts, total, count) in values:
+            for bucket_count, bucket in zip(counts, self.buckets):
+                le = format_labels(labels + (('le', bucket),))
+                yield f"{self.name}_bucket{le} {bucket_count}"
+            le = format_labels(labels + (('le', '+Inf'),))
+            yield f"{self.name}_bucket{le} {count}"
+            yield f"{self.name}_sum{format_labels(labels)} {total}"
+            yield f"{self.name}_count{format_labels(labels)} {count}"
+
+
+class Registry():
+    def __init__(self) -> None:
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self.metrics
+                         for line in metric.render()) + '\n'
+
+
+registry = Registry()
+STAGE_LATENCY = registry.register(Histogram(
+    'video_stage_latency_seconds', 'Time spent per pipeline stage of a video'))
+VIDEO_LATENCY = registry.register(Histogram(
+    'video_latency_seconds', 'Total time spent processing a video'))
+VIDEO_COUNTS = registry.register(Histogram(
+    'video_items',
+    'Frames sampled, faces detected and clusters produced per video',
+    COUNT_BUCKETS))
+VIDEO_BYTES = registry.register(Counter(
+    'video_bytes_downloaded_total', 'Bytes of video downloaded to the spool'))
+VIDEOS = registry.register(Counter(
+    'videos_processed_total', 'Videos processed by outcome'))
+PEAK_RSS = registry.register(Gauge(
+    'video_peak_rss_bytes',
+    'Peak resident memory seen while processing the last video'))
+RESULT_CACHE = registry.register(Counter(
+    'result_cache_requests_total', 'Result cache lookups by outcome'))
+IDEMPOTENCY_CHECKS = registry.register(Counter(
+    'idempotency_checks_total',
+    'Already processed checks by where they were answered'))
+ALERTS = registry.register(Counter(
+    'alerts_total', 'Alerts by outcome: sent, digested, dropped or failed'))
+LOG_RECORDS_DROPPED = registry.register(Counter(
+    'log_records_dropped_total',
+    'Log records dropped because the log queue was full'))
+
+
+def current_rss() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # process lifetime peak, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class VideoMetrics():
+    """
+    Timings and counts of the video processed by the current thread
+    """
+
+    def __init__(self, video_id) -> None:
+        self.video_id = video_id
+        self.stages = {}
+        self.counts = {}
+        self.peak_rss = current_rss()
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+    def inc(self, key: str, amount: int = 1) -> None:
+        self.counts[key] = self.counts.get(key, 0) + amount
+
+    def as_dict(self) -> dict:
+        return {'video_id': self.video_id,
+                'stages': {k: round(v, 3) for k, v in self.stages.items()},
+                'counts': dict(self.counts),
+                'peak_rss_mb': round(self.peak_rss / 2**20, 1)}
+
+
+state = threading.local()
+
+
+def current() -> VideoMetrics:
+    return getattr(state, 'video', None)
+
+
+@contextmanager
+def track_video(video_id):
+    """
+    Collect the metrics of one video processed by this thread and publish them
+    when it is done
+    """
+    video = VideoMetrics(video_id)
+    state.video = video
+    t1 = time.time()
+    outcome = 'success'
+    try:
+        yield video
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        state.video = None
+        VIDEO_LATENCY.observe(time.time() - t1)
+        VIDEOS.inc(outcome=outcome)
+        for stage, seconds in video.stages.items():
+            STAGE_LATENCY.observe(seconds, stage=stage)
+        for key in ('frames_sampled', 'faces_detected', 'clusters'):
+            if key in video.counts:
+                VIDEO_COUNTS.observe(video.counts[key], item=key)
+        PEAK_RSS.set(max(video.peak_rss, current_rss()))
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a pipeline stage of the current video, no-op outside `track_video`
+    """
+    t1 = time.time()
+    try:
+        yield
+    finally:
+        video = current()
+        if video is not None:
+            video.add_time(name, time.time() - t1)
+
+
+def inc(key: str, amount: int = 1) -> None:
+    video = current()
+    if video is not None:
+        video.inc(key, amount)
+
+
+def timed_iter(name: str, iterable: Iterable) -> Iterator:
+    """
+    Time only the work done inside a lazy iterable, e.g. decoding in a frame
+    generator
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header(
+            'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(port: int, host: str = '0.0.0.0') -> MetricsServer:
+    server = MetricsServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
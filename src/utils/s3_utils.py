@@ -0,0 +1,249 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+from src.utils import metrics
+
+
+class VideoSpool():
+    """
+    Downloads videos into a local directory of at most `max_bytes`, ahead of
+    their processing when `prefetch` is called for queued videos. Large files
+    are fetched with parallel HTTP range requests, a failed range is retried
+    from the last byte received. Least recently used videos are evicted to
+    make room, never while a message holding them (`prefetch` or `local`)
+    has not called `release`.
+    """
+
+    def __init__(self, spool_dir: str, max_bytes: int, connections: int = 4,
+                 part_size: int = 8*2**20, prefetch_workers: int = 2,
+                 retries: int = 3, timeout: float = 30) -> None:
+        self.spool_dir = spool_dir
+        self.max_bytes = max_bytes
+        self.connections = connections
+        self.part_size = part_size
+        self.retries = retries
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # url -> [Future of the local path, number of holders]
+        self.downloads = {}
+        self.pinned = {}  # path -> number of completed downloads holding it
+        self.reserved = 0  # bytes of the downloads in progress
+        self.executor = ThreadPoolExecutor(max_workers=prefetch_workers)
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def remove_partial_downloads(self) -> None:
+        """
+        Remove leftovers of downloads interrupted by a restart, before any
+        download starts
+        """
+        for name in os.listdir(self.spool_dir):
+            if name.endswith('.part'):
+                os.remove(os.path.join(self.spool_dir, name))
+
+    def local_path(self, url: str) -> str:
+        ext = os.path.splitext(urlparse(url).path)[1][:8]
+        return os.path.join(
+            self.spool_dir,
+            hashlib.sha1(url.encode('utf-8')).hexdigest()[:20] + ext)
+
+    def prefetch(self, url: str) -> Future:
+        """
+        Start downloading a video in the background, once per url. Every
+        call holds the video until a matching `release`.
+        """
+        with self.lock:
+            entry = self.downloads.get(url)
+            if entry is None:
+                entry = [self.executor.submit(self.download, url), 0]
+                self.downloads[url] = entry
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, url: str) -> None:
+        """
+        Drop a hold on a video, e.g. once its message is processed or skipped
+        """
+        with self.lock:
+            entry = self.downloads.get(url)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self.downloads[url]
+            future = entry[0]
+        if not future.cancel():
+            future.add_done_callback(self.unpin_download)
+
+    def unpin_download(self, future: Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self.lock:
+            self.unpin(future.result())
+
+    def pin(self, path: str) -> None:
+        self.pinned[path] = self.pinned.get(path, 0) + 1
+
+    def unpin(self, path: str) -> None:
+        if path in self.pinned:
+            self.pinned[path] -= 1
+            if self.pinned[path] == 0:
+                del self.pinned[path]
+
+    @contextmanager
+    def local(self, url: str):
+        """
+        Local path of a video for the duration of the block, the url itself
+        when it is a local file or could not be spooled
+        """
+        if os.path.exists(url):
+            yield url
+            return
+        future = self.prefetch(url)
+        try:
+            with metrics.stage('download'):
+                path = future.result()
+                if path != url and not os.path.exists(path):
+                    # removed from the spool by something else than eviction,
+                    # download it again
+                    with self.lock:
+                        entry = self.downloads[url]
+                        if entry[0] is future:
+                            self.unpin(path)
+                            entry[0] = self.executor.submit(self.download, url)
+                        future = entry[0]
+                    path = future.result()
+            yield path
+        finally:
+            self.release(url)
+
+    def download(self, url: str) -> str:
+        """
+        Local path of a video once downloaded, pinned until its holders release
+        it
+        """
+        path = self.local_path(url)
+        with self.lock:
+            if os.path.exists(path):
+                os.utime(path)
+                self.pin(path)
+                return path
+        size, accepts_ranges = self.probe(url)
+        if not self.reserve(size or 0):
+            # larger than the spool, decode straight from the url
+            return url
+        # unique per process, another process may download the same url
+        part = f"{path}.{os.getpid()}.part"
+        try:
+            if size and accepts_ranges and size > self.part_size:
+                self.download_ranges(url, part, size)
+            else:
+                self.download_range(url, part, 0, None)
+            with self.lock:
+                os.replace(part, path)
+                self.pin(path)
+        except Exception:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        finally:
+            with self.lock:
+                self.reserved -= size or 0
+        return path
+
+    def probe(self, url: str) -> Tuple[Optional[int], bool]:
+        try:
+            response = requests.head(
+                url, timeout=self.timeout, allow_redirects=True)
+            response.raise_for_status()
+        except requests.RequestException:
+            return None, False
+        size = response.headers.get('Content-Length')
+        ranged = response.headers.get('Accept-Ranges') == 'bytes'
+        return (int(size) if size else None), ranged
+
+    def reserve(self, size: int) -> bool:
+        """
+        Evict least recently used videos until `size` more bytes fit in the
+        spool
+        """
+        if size > self.max_bytes:
+            return False
+        with self.lock:
+            files = []
+            for name in os.listdir(self.spool_dir):
+                path = os.path.join(self.spool_dir, name)
+                if not name.endswith('.part') and os.path.isfile(path):
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, stat.st_size, path))
+            used = self.reserved + sum(file_size for _, file_size, _ in files)
+            for _, file_size, path in sorted(files):
+                if used + size <= self.max_bytes:
+                    break
+                if path not in self.pinned:
+                    os.remove(path)
+                    used -= file_size
+            if used + size > self.max_bytes:
+                return False
+            self.reserved += size
+            return True
+
+    def download_ranges(self, url: str, part: str, size: int) -> None:
+        with open(part, 'wb') as f:
+            f.truncate(size)
+        ranges = [(start, min(start + self.part_size, size) - 1)
+                  for start in range(0, size, self.part_size)]
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            futures = [executor.submit(self.download_range, url, part, start,
+                                       end) for start, end in ranges]
+            for future in futures:
+                future.result()
+
+    def download_range(self, url: str, part: str, start: int,
+                       end: Optional[int]) -> None:
+        """
+        Write bytes `start` to `end` (inclusive, None for the whole file) of
+        `url` into `part`
+        """
+        offset = start
+        mode = 'r+b' if end is not None else 'wb'
+        with open(part, mode) as f:
+            for attempt in range(self.retries + 1):
+                headers = {}
+                if end is not None or offset > 0:
+                    last = '' if end is None else end
+                    headers['Range'] = f"bytes={offset}-{last}"
+                try:
+                    response = requests.get(url, headers=headers, stream=True,
+                                            timeout=self.timeout)
+                    response.raise_for_status()
+                    if 'Range' in headers and response.status_code != 206:
+                        if end is not None:
+                            raise ValueError(
+                                f"Range requests are not supported by {url}")
+                        # resuming is not supported, start over
+                        f.seek(0)
+                        f.truncate()
+                        offset = 0
+                    f.seek(offset)
+                    # small chunks, a retry resumes after the last complete one
+                    for chunk in response.iter_content(chunk_size=64*1024):
+                        f.write(chunk)
+                        offset += len(chunk)
+                        # counted as read, retried ranges included
+                        metrics.VIDEO_BYTES.inc(len(chunk))
+                    if end is None or offset > end:
+                        return
+                    raise IOError(f"Incomplete range {start}-{end} of {url}")
+                except (requests.RequestException, IOError):
+                    if attempt == self.retries:
+                        raise
+                    time.sleep(0.5 * 2**attempt)
@@ -0,0 +1,136 @@
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+
+import cv2
+
+# interval multipliers tried, in order, to fit a video in its budget
+SAMPLING_STEPS = (1, 2, 3, 5, 10, 20, 30)
+
+
+class VideoProbe(NamedTuple):
+    duration: float  # seconds
+    fps: float
+    width: int
+    height: int
+
+
+def probe_video(url: str, timeout: float = None) -> Optional[VideoProbe]:
+    """
+    Container metadata of a video, read without decoding any frame
+
+    :param timeout: seconds to open the video and read its header, left to
+        FFmpeg when None
+    """
+    if timeout is None:
+        video = cv2.VideoCapture(url)
+    else:
+        milliseconds = int(timeout * 1000)
+        video = cv2.VideoCapture(url, cv2.CAP_FFMPEG, [
+            cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, milliseconds,
+            cv2.CAP_PROP_READ_TIMEOUT_MSEC, milliseconds])
+    try:
+        if not video.isOpened():
+            return None
+        fps = video.get(cv2.CAP_PROP_FPS)
+        frame_count = video.get(cv2.CAP_PROP_FRAME_COUNT)
+        if fps <= 0 or frame_count <= 0:
+            return None
+        return VideoProbe(frame_count / fps, fps,
+                          int(video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                          int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    finally:
+        video.release()
+
+
+class VideoScheduler():
+    """
+    Estimates the seconds a video takes to analyse from its container metadata
+    and picks the sampling that fits it in `budget` seconds: the sampling
+    interval is multiplied by `SAMPLING_STEPS` up to `max_every_x_seconds`,
+    seeking to sampled frames instead of grabbing every frame once the
+    interval alone is not enough. Estimates are scaled by the ratio of the
+    observed to the estimated seconds of finished videos. Probes are cached
+    by url, a video probed remotely is not probed again once downloaded.
+    """
+
+    def __init__(self, budget: float, max_duration: float = 10*60,
+                 decode_seconds_per_megapixel: float = 0.002,
+                 seconds_per_sample: float = 0.05,
+                 max_every_x_seconds: float = 30, probes_size: int = 256,
+                 probe_timeout: float = None) -> None:
+        self.budget = budget
+        self.max_duration = max_duration
+        self.decode_seconds_per_megapixel = decode_seconds_per_megapixel
+        self.seconds_per_sample = seconds_per_sample
+        self.max_every_x_seconds = max_every_x_seconds
+        self.probes_size = probes_size
+        self.probe_timeout = probe_timeout
+        self.scale = 1.0
+        self.lock = threading.Lock()
+        # url -> VideoProbe, least recently used first
+        self.probes = OrderedDict()
+
+    def probe(self, url: str, key: str = None) -> Optional[VideoProbe]:
+        """
+        :param key: url the probe is cached under, e.g. the remote url of a
+            downloaded video
+        """
+        key = key or url
+        with self.lock:
+            if self.probes.get(key) is not None:
+                self.probes.move_to_end(key)
+                return self.probes[key]
+        probe = probe_video(url, self.probe_timeout)
+        with self.lock:
+            self.probes[key] = probe
+            while len(self.probes) > self.probes_size:
+                self.probes.popitem(last=False)
+        return probe
+
+    def estimate(self, probe: VideoProbe, every_x_seconds: float,
+                 seek: bool = False) -> float:
+        duration = min(probe.duration, self.max_duration)
+        samples = duration / every_x_seconds
+        # seeking decodes from the previous keyframe, about a second of frames
+        decoded = samples * probe.fps if seek else duration * probe.fps
+        megapixels = probe.width * probe.height / 1e6
+        return self.scale * (
+            decoded * megapixels * self.decode_seconds_per_megapixel
+            + samples * self.seconds_per_sample)
+
+    def cost(self, url: str, every_x_seconds: float) -> float:
+        """
+        Estimated seconds of a video at the configured sampling, the budget
+        when it cannot be probed
+        """
+        probe = self.probe(url)
+        return self.estimate(probe, every_x_seconds) if probe is not None \
+            else self.budget
+
+    def plan(self, url: str, every_x_seconds: float, key: str = None
+             ) -> Tuple[float, bool, Optional[float]]:
+        """
+        :param key: url the probe is cached under, `url` when None
+        :return: sampling interval, whether to seek and the estimated seconds,
+            None if the video could not be probed
+        """
+        probe = self.probe(url, key)
+        if probe is None:
+            return every_x_seconds, False, None
+        longest = max(self.max_every_x_seconds, every_x_seconds)
+        candidates = [every_x_seconds * step for step in SAMPLING_STEPS
+                      if every_x_seconds * step <= longest]
+        for candidate in candidates:
+            for seek in (False, True):
+                estimate = self.estimate(probe, candidate, seek)
+                if estimate <= self.budget:
+                    return candidate, seek, estimate
+        return candidates[-1], True, self.estimate(probe, candidates[-1], True)
+
+    def observe(self, estimate: float, seconds: float) -> None:
+        if estimate is None or estimate <= 0 or seconds <= 0:
+            return
+        ratio = min(max(self.scale * seconds / estimate, 0.1), 10)
+        with self.lock:
+            self.scale = 0.8 * self.scale + 0.2 * ratio
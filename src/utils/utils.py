@@ -1,25 +1,179 @@
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 import re
+import threading
+import time
 import requests
 import json
-from consts import SLACK_WEBHOOK
+from consts import SLACK_WEBHOOK, AlertConsts
+from src.utils import metrics
+
+class VideoMetricsFilter(logging.Filter):
+    """
+    Attach the metrics of the video being processed by the logging thread to
+    each record
+    """
+    def filter(self, record):
+        video = metrics.current()
+        record.video_metrics = video.as_dict() if video is not None else None
+        record.metrics = f" | {json.dumps(record.video_metrics)}" \
+            if video is not None else ""
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that drops records instead of blocking once the queue is full
+    """
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_RECORDS_DROPPED.inc()
 
 def get_logger():
-    frmtr = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    frmtr = logging.Formatter(
+        "%(asctime)s - %(levelname)s - %(message)s%(metrics)s")
     hndlr = logging.StreamHandler(sys.stdout)
     hndlr.setFormatter(frmtr)
+    # records are written by a listener thread, the metrics of the video are
+    # attached in the logging thread before they are queued
+    records = queue.Queue(AlertConsts.LOG_QUEUE_SIZE)
+    queue_hndlr = DroppingQueueHandler(records)
+    queue_hndlr.addFilter(VideoMetricsFilter())
+    listener = logging.handlers.QueueListener(records, hndlr)
+    listener.start()
+    atexit.register(listener.stop)
     logger = logging.getLogger(__name__)
-    logger.addHandler(hndlr)
+    logger.addHandler(queue_hndlr)
     logger.setLevel(logging.DEBUG)
     return logger
 
 logger = get_logger()
 
+def alert_signature(message: str) -> str:
+    """
+    Alerts differing only by urls, ids or numbers share a signature
+    """
+    signature = re.sub(r'\S+://\S+', '<url>', message)
+    signature = re.sub(r'\b[0-9a-fA-F-]{8,}\b|\d+', '<n>', signature)
+    return signature[:200]
+
+class AlertDispatcher():
+    """
+    Posts alerts to a Slack webhook from a background thread, so a slow
+    webhook never blocks the caller. The queue is bounded, newer alerts are
+    dropped once it is full. An alert is posted at once unless one with the
+    same signature was posted in the last `dedup_seconds` or more than
+    `rate_per_minute` were posted, it then goes to a digest posted every
+    `digest_seconds`.
+    """
+
+    def __init__(self, webhook: str, queue_size: int = 1000,
+                 rate_per_minute: float = 10, dedup_seconds: float = 600,
+                 digest_seconds: float = 300, timeout: float = 5) -> None:
+        self.webhook = webhook
+        self.rate_per_minute = rate_per_minute
+        self.dedup_seconds = dedup_seconds
+        self.digest_seconds = digest_seconds
+        self.timeout = timeout
+        self.alerts = queue.Queue(queue_size)
+        self.tokens = rate_per_minute
+        self.tokens_at = time.time()
+        self.last_sent = {}  # signature -> time its alert was last posted
+        self.digest = {}  # signature -> [count, last message]
+        self.next_digest = time.time() + digest_seconds
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def send(self, message: str) -> None:
+        try:
+            self.alerts.put_nowait(message)
+        except queue.Full:
+            metrics.ALERTS.inc(outcome='dropped')
+
+    def run(self) -> None:
+        while True:
+            try:
+                message = self.alerts.get(
+                    timeout=max(self.next_digest - time.time(), 0.01))
+                self.dispatch(message)
+            except queue.Empty:
+                pass
+            if time.time() >= self.next_digest:
+                self.send_digest()
+
+    def take_token(self) -> bool:
+        now = time.time()
+        self.tokens = min(
+            self.rate_per_minute,
+            self.tokens + (now - self.tokens_at) * self.rate_per_minute / 60)
+        self.tokens_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def dispatch(self, message: str) -> None:
+        signature = alert_signature(message)
+        last_sent = self.last_sent.get(signature)
+        if (last_sent is None
+                or time.time() - last_sent >= self.dedup_seconds) \
+                and self.take_token():
+            self.last_sent[signature] = time.time()
+            self.post(message)
+        else:
+            pending = self.digest.setdefault(signature, [0, message])
+            pending[0] += 1
+            pending[1] = message
+            metrics.ALERTS.inc(outcome='digested')
+
+    def send_digest(self) -> None:
+        self.next_digest = time.time() + self.digest_seconds
+        self.last_sent = {signature: sent
+                          for signature, sent in self.last_sent.items()
+                          if time.time() - sent < self.dedup_seconds}
+        if len(self.digest) == 0 or not self.take_token():
+            return
+        digest, self.digest = self.digest, {}
+        lines = [f"{count}x {message}" for count, message in sorted(
+            digest.values(), key=lambda i: i[0], reverse=True)]
+        total = sum(count for count, _ in digest.values())
+        self.post(f"{total} repeated alerts since the last digest:\n"
+                  + "\n".join(lines[:20]))
+
+    def post(self, message: str) -> None:
+        payload = {
+            "text": f"*{'ALERT FROM VIDEO-TEXT-DETECTION REPO'}*\n{message}"}
+        try:
+            response = requests.post(
+                url=self.webhook, data=json.dumps(payload),
+                timeout=self.timeout)
+            response.raise_for_status()
+            metrics.ALERTS.inc(outcome='sent')
+        except requests.RequestException:
+            logger.warning("Unable to post alert", exc_info=True)
+            metrics.ALERTS.inc(outcome='failed')
+
+alert_dispatcher = None
+alert_lock = threading.Lock()
+
 def send_alert(message):
-    message = f"*{'ALERT FROM VIDEO-TEXT-DETECTION REPO'}*\n{message}"
-    payload = {"text": message}
-    requests.post(url=SLACK_WEBHOOK, data=json.dumps(payload))
+    global alert_dispatcher
+    if not SLACK_WEBHOOK:
+        return
+    with alert_lock:
+        if alert_dispatcher is None:
+            alert_dispatcher = AlertDispatcher(
+                SLACK_WEBHOOK, AlertConsts.QUEUE_SIZE,
+                AlertConsts.RATE_PER_MINUTE, AlertConsts.DEDUP_SECONDS,
+                AlertConsts.DIGEST_SECONDS, AlertConsts.TIMEOUT)
+    alert_dispatcher.send(message)
+
+def to_json(value):
+    # numpy scalars of the aggregated cluster info
+    return value.item() if hasattr(value, 'item') else str(value)
 
 def custom_json_deserializer(v):
     if v is None:
@@ -1,15 +1,44 @@
 import cv2
+import time
 import numpy as np
-from typing import Tuple, List
-from consts import FRAME_EVERY_X_SECONDS
+from collections import deque
+from typing import Tuple, List, Iterator, Optional
+from consts import FRAME_EVERY_X_SECONDS, FRAME_DEDUP_DISTANCE, \
+    VIDEO_TIME_BUDGET
+from src.utils import metrics
 
 class VideoUtils():
-    def __init__(self, URL: str, col_count: int = 10, row_count: int = 4) -> None:
+    def __init__(self, URL: str, col_count: int = 10, row_count: int = 4,
+                 streaming: bool = False, seek: bool = False,
+                 downscale: bool = False,
+                 dedup_distance: int = FRAME_DEDUP_DISTANCE,
+                 time_budget: float = VIDEO_TIME_BUDGET,
+                 frame_every_x_seconds: float = FRAME_EVERY_X_SECONDS) -> None:
         self.URL = URL
         self.col_count = col_count
         self.row_count = row_count
         self.max_duration = 10*60*1000  # 10 minutes
-        self.frame_every_x_seconds = FRAME_EVERY_X_SECONDS
+        self.frame_every_x_seconds = frame_every_x_seconds
+        self.seek = seek
+        # merged frames are already resized for detection
+        self.downscale = downscale
+        self.dedup_distance = dedup_distance
+        # no frame is decoded past the deadline
+        self.deadline = time.time() + time_budget if time_budget else None
+        # (start, end) ms ranges to sample, set by `refineAround`
+        self.sample_ranges = None
+        # sampled frames each kept frame stands for, and the same per cell of
+        # each merged frame
+        self.frame_weights = []
+        self.merged_weights = []
+        if streaming:
+            # frames are decoded lazily while `merged_frames` is consumed
+            self.video = cv2.VideoCapture(self.URL)
+            self.success = self.video.isOpened()
+            if self.success:
+                self.merged_frames = self.iterMergedFrames()
+            return
+
         self.success, self.frames = self.getVideoFrames()
         # print("self.success:", self.success)
         if self.success:
@@ -17,6 +46,191 @@ class VideoUtils():
             self.merged_frames = self.mergeFrames()
             self.same_location_thresh = self.height // 180
 
+    def iterSampledFrames(self, video: cv2.VideoCapture = None,
+                          every_x_seconds: float = None, seek: bool = None
+                          ) -> Iterator[Tuple[float, np.ndarray]]:
+        '''
+        Lazily decode one frame every `frame_every_x_seconds` seconds, or
+        `every_x_seconds` if given, only within `sample_ranges` once set.
+        Skipped frames are only grabbed and never decoded, or with
+        `seek=True` skipped entirely by seeking to the next timestamp.
+
+        yield:
+            timestamp: float, position of the frame in milliseconds
+            frame: np.ndarray, decoded frame
+        '''
+
+        if video is None:
+            # reuse the capture opened by a streaming constructor only once
+            video, self.video = getattr(self, 'video', None), None
+        if video is None:
+            video = cv2.VideoCapture(self.URL)
+        fps = int(video.get(cv2.CAP_PROP_FPS))
+        if not video.isOpened() or fps <= 0:
+            video.release()
+            return
+
+        seek = self.seek if seek is None else seek
+        if every_x_seconds is None:
+            every_x_seconds = self.frame_every_x_seconds
+        try:
+            frame_index = 0
+            for target in self.getSampleTargets(video, fps, every_x_seconds):
+                if self.deadline is not None and time.time() > self.deadline:
+                    metrics.inc('budget_exceeded')
+                    break
+                ret, cur_frame, frame_index = self.readTarget(
+                    video, target, fps, seek, frame_index)
+                if not ret:
+                    break
+                metrics.inc('frames_sampled')
+                yield target * 1000 / fps, cur_frame
+        finally:
+            video.release()
+
+    def getSampleTargets(self, video: cv2.VideoCapture, fps: int,
+                         every_x_seconds: float) -> List[int]:
+        '''
+        Indexes of the frames sampled every `every_x_seconds` seconds, only
+        within `sample_ranges` once set
+        '''
+
+        step = max(int(fps*every_x_seconds), 1)
+        max_frames = fps*self.max_duration // 1000
+        # sampled frames are 1, 1+step, 1+2*step, ...
+        targets = range(1 if step > 1 else 0, max_frames + 1, step)
+        if self.sample_ranges is not None:
+            targets = self.getRangeTargets(targets, video, fps)
+        return targets
+
+    @staticmethod
+    def readTarget(video: cv2.VideoCapture, target: int, fps: int, seek: bool,
+                   frame_index: int) -> Tuple[bool, Optional[np.ndarray], int]:
+        '''
+        Decode frame `target`, seeking to it or grabbing the frames from
+        `frame_index` on
+
+        return:
+            ret: bool, whether the frame was decoded
+            frame: np.ndarray, decoded frame
+            frame_index: int, index of the next frame when reading sequentially
+        '''
+
+        if seek:
+            video.set(cv2.CAP_PROP_POS_MSEC, target * 1000 / fps)
+            ret, frame = video.read()
+            return ret, frame, frame_index
+        while frame_index < target and video.grab():
+            frame_index += 1
+        if frame_index < target or not video.grab():
+            return False, None, frame_index
+        ret, frame = video.retrieve()
+        return ret, frame, frame_index + 1
+
+    def getRangeTargets(self, targets: range, video: cv2.VideoCapture,
+                        fps: int) -> List[int]:
+        '''
+        Sampled frame indexes within `sample_ranges`, without the last 5
+        samples of the whole video as `iterVideoFrames` would drop them
+        '''
+
+        frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        if frame_count > 0:
+            targets = targets[:len(range(
+                targets.start, min(targets.stop, frame_count), targets.step))]
+            if len(targets) > 20:
+                targets = targets[:-5]
+        return [target for target in targets
+                if any(start <= target * 1000 / fps <= end
+                       for start, end in self.sample_ranges)]
+
+    def refineAround(
+            self, timestamps: List[float], window_seconds: float) -> None:
+        '''
+        Only sample frames within `window_seconds` of the given timestamps (ms)
+        from now on
+        '''
+
+        ranges = []
+        for timestamp in sorted(timestamps):
+            start = timestamp - window_seconds*1000
+            end = timestamp + window_seconds*1000
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        self.sample_ranges = ranges
+
+    def iterVideoFrames(self) -> Iterator[Tuple[float, np.ndarray]]:
+        '''
+        Lazily yield sampled frames with their timestamp in milliseconds,
+        dropping the last 5 frames (5 seconds) once more than 20 frames were
+        sampled
+        '''
+
+        if self.sample_ranges is not None:
+            # the tail is already left out of the ranges
+            yield from metrics.timed_iter('decode', self.iterSampledFrames())
+            return
+
+        tail = deque()
+        sampled = 0
+        for timestamp, cur_frame in metrics.timed_iter(
+                'decode', self.iterSampledFrames()):
+            sampled += 1
+            tail.append((timestamp, cur_frame))
+            if sampled > 20:
+                while len(tail) > 5:
+                    yield tail.popleft()
+        if sampled <= 20:
+            yield from tail
+
+    def iterDistinctFrames(self) -> Iterator[Tuple[float, np.ndarray]]:
+        '''
+        Lazily yield sampled frames, skipping the ones whose hash is within
+        `dedup_distance` bits of the last kept frame. A frame is yielded once
+        the next distinct frame is found, its weight (itself plus the frames
+        skipped after it) is appended to `frame_weights` just before.
+        '''
+
+        if self.dedup_distance < 0:
+            for timestamp, frame in self.iterVideoFrames():
+                self.frame_weights.append(1)
+                yield timestamp, frame
+            return
+
+        kept, kept_hash, weight = None, None, 0
+        for timestamp, frame in self.iterVideoFrames():
+            with metrics.stage('dedup'):
+                frame_hash = self.getFrameHash(frame)
+                duplicate = kept is not None and np.unpackbits(
+                    frame_hash ^ kept_hash).sum() <= self.dedup_distance
+            if duplicate:
+                weight += 1
+                metrics.inc('frames_skipped')
+                continue
+            if kept is not None:
+                self.frame_weights.append(weight)
+                yield kept
+            kept, kept_hash, weight = (timestamp, frame), frame_hash, 1
+        if kept is not None:
+            self.frame_weights.append(weight)
+            yield kept
+
+    @staticmethod
+    def getFrameHash(frame: np.ndarray) -> np.ndarray:
+        '''
+        64-bit difference hash of a frame: sign of the horizontal gradients of
+        a 9x8 grayscale thumbnail
+
+        return:
+            hash: np.ndarray, 8 packed bytes
+        '''
+
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        thumb = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+        return np.packbits(thumb[:, 1:] > thumb[:, :-1])
+
     def getVideoFrames(self) -> Tuple[bool, List]:
         '''
         Get list of frames from video
@@ -26,36 +240,32 @@ class VideoUtils():
             frames: list, list of frames
         '''
 
-        video = cv2.VideoCapture(self.URL)
-        if not video.isOpened():
-            return False, []
+        frames = [frame for _, frame in self.iterDistinctFrames()]
+        return len(frames) > 0, frames
 
-        currentframe = 0
-        fps = int(video.get(cv2.CAP_PROP_FPS))
-        frames = []
-        while(video.isOpened()):
-            ret, cur_frame = video.read()
-            if currentframe > fps*self.max_duration:
-                break
-            if ret:
-                if currentframe % (fps*self.frame_every_x_seconds) == 1:
-                    cur_frame = cv2.copyMakeBorder(cur_frame, 15, 15, 15, 15, cv2.BORDER_CONSTANT, value=(
-                        0, 255, 0))  # add border to frame
-                    frames.append(cur_frame)
-                currentframe += 1
-            else:
-                break
-
-        video.release()
+    def iterMergedFrames(self) -> Iterator[np.ndarray]:
+        '''
+        Lazily merge frames into single images of at most
+        `row_count` x `col_count` frames as they are decoded
 
-        if len(frames) > 20:
-            frames = frames[:-5]  # remove last 5 frames (5 seconds)
+        yield:
+            merged_frame: np.ndarray, merged image
+        '''
 
-        # add dummy frames to merged image to make number of images per row constant
-        for _ in range(self.col_count - len(frames) % self.col_count):
-            frames.append(frames[-1])
+        self.mosaic_builder = MosaicBuilder(
+            self.col_count, self.row_count, downscale=self.downscale)
+        for _, frame in self.iterDistinctFrames():
+            with metrics.stage('merge_frames'):
+                merged_frame = self.mosaic_builder.add(
+                    frame, self.frame_weights[-1])
+            if merged_frame is not None:
+                self.merged_weights.append(self.mosaic_builder.last_weights)
+                yield merged_frame
 
-        return True, frames
+        merged_frame = self.mosaic_builder.flush()
+        if merged_frame is not None:
+            self.merged_weights.append(self.mosaic_builder.last_weights)
+            yield merged_frame
 
     def mergeFrames(self) -> List:
         '''
@@ -65,28 +275,137 @@ class VideoUtils():
             merged_frames: list of merged frames
         '''
 
-        rows = []
-        col_count = self.col_count
-        row_count = self.row_count
-        len_frames = len(self.frames)
+        self.mosaic_builder = MosaicBuilder(
+            self.col_count, self.row_count, downscale=self.downscale)
+        merged_frames = []
+        for frame, weight in zip(self.frames, self.frame_weights):
+            merged_frame = self.mosaic_builder.add(frame, weight)
+            if merged_frame is not None:
+                merged_frames.append(merged_frame)
+                self.merged_weights.append(self.mosaic_builder.last_weights)
 
-        for i in range(col_count, len_frames+col_count, col_count):
-            # stack horizontally
-            rows.append(np.hstack(self.frames[i-col_count:i]))
+        merged_frame = self.mosaic_builder.flush()
+        if merged_frame is not None:
+            merged_frames.append(merged_frame)
+            self.merged_weights.append(self.mosaic_builder.last_weights)
 
-        len_rows = len(rows)
-        merged_frames = []
-        # print(len_rows, row_count)
-        if len_rows > row_count:
-            for i in range(row_count, len_rows, row_count):
-                img = np.vstack(rows[i-row_count:i])  # stack vertically
-                merged_frames.append(img)
-
-            extras = len_rows % row_count
-            if extras > 0:
-                img = np.vstack(rows[len_rows-extras:len_rows])
-                merged_frames.append(img)
+        return merged_frames
+
+    @staticmethod
+    def getScaleFactor(height: int, width: int) -> float:
+        '''
+        Resize factor applied to a merged image before face detection
+        '''
+
+        area = (height * width)/10000
+        f = -0.0001*area + 0.75
+        if f > 1:
+            f = 1
+        elif f < 0:
+            f = 0.2
+        return f
+
+
+class MosaicBuilder():
+    """
+    Writes frames directly into preallocated merged images of
+    `row_count` x `col_count` bordered cells, optionally already downscaled
+    by `VideoUtils.getScaleFactor` of a full merged image. The weight of
+    every cell is kept in `last_weights` of the merged image last returned.
+    """
+
+    def __init__(self, col_count: int = 10, row_count: int = 4,
+                 border: int = 15,
+                 border_colour: Tuple[int, int, int] = (0, 255, 0),
+                 downscale: bool = False) -> None:
+        self.col_count = col_count
+        self.row_count = row_count
+        self.border = border
+        self.border_colour = border_colour
+        self.downscale = downscale
+        self.scale = 1.0
+        self.cell_h = None
+        self.canvas = None
+        self.slot = 0
+        self.weights = np.zeros((row_count, col_count), dtype=np.int32)
+        self.last_weights = None
+
+    def setup(self, frame: np.ndarray) -> None:
+        height, width = frame.shape[:2]
+        cell_h, cell_w = height + 2*self.border, width + 2*self.border
+        if self.downscale:
+            self.scale = VideoUtils.getScaleFactor(
+                cell_h*self.row_count, cell_w*self.col_count)
+        self.cell_h = int(round(cell_h * self.scale))
+        self.cell_w = int(round(cell_w * self.scale))
+        self.pad = int(round(self.border * self.scale))
+        self.frame_size = (self.cell_w - 2*self.pad, self.cell_h - 2*self.pad)
+
+    def newCanvas(self, dtype: np.dtype) -> np.ndarray:
+        canvas = np.empty((self.row_count*self.cell_h,
+                           self.col_count*self.cell_w, 3), dtype=dtype)
+        # only the borders need the colour, cells are overwritten by frames
+        for r in range(self.row_count):
+            top = r*self.cell_h
+            canvas[top:top+self.pad] = self.border_colour
+            bottom = top+self.cell_h
+            canvas[bottom-self.pad:bottom] = self.border_colour
+        for c in range(self.col_count):
+            left = c*self.cell_w
+            canvas[:, left:left+self.pad] = self.border_colour
+            right = left+self.cell_w
+            canvas[:, right-self.pad:right] = self.border_colour
+        return canvas
+
+    def cell(self, slot: int) -> np.ndarray:
+        r, c = divmod(slot, self.col_count)
+        top, left = r*self.cell_h + self.pad, c*self.cell_w + self.pad
+        return self.canvas[
+            top:top+self.frame_size[1], left:left+self.frame_size[0]]
+
+    def add(self, frame: np.ndarray, weight: int = 1) -> Optional[np.ndarray]:
+        '''
+        Write a frame into the next free cell
+
+        return:
+            merged_frame: np.ndarray, the merged image once all its cells are
+                filled, else None
+        '''
+
+        if self.cell_h is None:
+            self.setup(frame)
+        if self.canvas is None:
+            self.canvas = self.newCanvas(frame.dtype)
+
+        cell = self.cell(self.slot)
+        if frame.shape[:2] == cell.shape[:2]:
+            cell[...] = frame
         else:
-            merged_frames = rows
+            resized = cv2.resize(frame, self.frame_size, dst=cell)
+            if resized is not cell:
+                cell[...] = resized
+        self.weights.flat[self.slot] = weight
+        self.slot += 1
 
-        return merged_frames
+        if self.slot == self.row_count*self.col_count:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[np.ndarray]:
+        '''
+        Return the partially filled merged image, cropped to its used rows
+        with unused cells of the last row left blank
+        '''
+
+        if self.canvas is None:
+            return None
+
+        rows = -(-self.slot // self.col_count)
+        for slot in range(self.slot, rows*self.col_count):
+            self.cell(slot)[...] = self.border_colour
+        merged_frame = self.canvas[:rows*self.cell_h]
+        self.weights.flat[self.slot:] = 0
+        self.last_weights = self.weights[:rows].copy()
+        self.canvas = None
+        self.slot = 0
+        return merged_frame
@@ -0,0 +1,25 @@
+import threading
+
+from src.utils.db_utils import WriteBehindBatcher
+
+
+class ListDatabase():
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql, params=()):
+        self.statements.append(params)
+
+
+def test_wait_returns_once_the_writes_are_flushed():
+    database = ListDatabase()
+    batcher = WriteBehindBatcher(database, batch_size=100, flush_seconds=0.1)
+    batcher.add('status', 'SUCCESS', 7, (1, 2, 7))
+    assert batcher.is_pending(7)
+
+    waiter = threading.Thread(target=batcher.wait, args=(7,))
+    waiter.start()
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert not batcher.is_pending(7)
+    assert database.statements == [(1, 2, 7, 'SUCCESS')]
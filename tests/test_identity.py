@@ -0,0 +1,44 @@
+import threading
+
+import numpy as np
+
+from src.models.identity import IdentityIndex
+
+
+def test_concurrent_updates_of_a_user_are_not_lost(tmp_path):
+    index = IdentityIndex(str(tmp_path), max_per_user=4, max_count=10000)
+    centroid = np.zeros(8, dtype=np.float32)
+    attributes = lambda known: (1.0, 30.0, 4.0)  # noqa: E731
+
+    def observe():
+        for _ in range(50):
+            index.match_or_update(7, centroid, 2, attributes)
+
+    threads = [threading.Thread(target=observe) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    known = index.match(7, centroid)
+    assert known.count == 4 * 50 * 2
+    assert (known.gender, known.age, known.skin_tone) == (1.0, 30.0, 4.0)
+
+
+def test_attributes_depend_on_the_match(tmp_path):
+    index = IdentityIndex(str(tmp_path))
+    centroid = np.zeros(8, dtype=np.float32)
+    matched = []
+
+    def attributes(known):
+        matched.append(known is not None)
+        return 0.0 if known is None else 1.0, 20.0, np.nan
+
+    known, (gender, age, skin_tone) = index.match_or_update(
+        7, centroid, 1, attributes)
+    assert known is None and (gender, age) == (0.0, 20.0)
+    known, (gender, age, skin_tone) = index.match_or_update(
+        7, centroid, 1, attributes)
+    assert matched == [False, True]
+    assert known.count == 1 and gender == 0.5 and age == 20.0
+    assert np.isnan(skin_tone)
@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from src.utils.kafka_utils import WorkerPoolConsumer
+
+Message = namedtuple('Message', ['topic', 'partition', 'offset', 'value'])
+
+
+def test_priority_is_estimated_off_the_poll_loop():
+    probing = threading.Event()
+    handled = []
+
+    def priority(message):
+        if message.value == 'slow':
+            probing.wait(5)
+        return 60 if message.value == 'slow' else 0
+
+    pool = WorkerPoolConsumer(
+        None, lambda message: handled.append(message.value), worker_count=1,
+        priority=priority)
+    executor = ThreadPoolExecutor(max_workers=1)
+    estimator = ThreadPoolExecutor(max_workers=2)
+    try:
+        t1 = time.time()
+        pool.dispatch(executor, Message('topic', 0, 0, 'slow'), estimator)
+        pool.dispatch(executor, Message('topic', 0, 1, 'fast'), estimator)
+        assert time.time() - t1 < 1
+        for _ in range(100):
+            if handled:
+                break
+            time.sleep(0.01)
+        # the message still being estimated does not hold back the next one
+        assert handled == ['fast']
+        probing.set()
+        for _ in range(100):
+            if len(handled) == 2:
+                break
+            time.sleep(0.01)
+        assert handled == ['fast', 'slow']
+    finally:
+        probing.set()
+        pool.stop(executor, estimator)
+
+
+class ListConsumer():
+    """
+    Returns `messages` on the first poll, nothing after
+    """
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.commits = []
+
+    def poll(self, timeout_ms):
+        messages, self.messages = self.messages, []
+        time.sleep(timeout_ms / 1000)
+        return {'topic-0': messages} if messages else {}
+
+    def commit(self, commits):
+        self.commits.append(commits)
+
+    def assignment(self):
+        return set()
+
+    def paused(self):
+        return set()
+
+    def pause(self, *partitions):
+        pass
+
+    def resume(self, *partitions):
+        pass
+
+
+def test_request_stop_finishes_and_commits_running_messages():
+    started = threading.Event()
+
+    def handler(message):
+        started.set()
+        time.sleep(0.2)
+
+    consumer = ListConsumer([Message('topic', 0, 0, 'video')])
+    pool = WorkerPoolConsumer(consumer, handler, worker_count=1,
+                              poll_timeout_ms=10)
+    stopper = threading.Thread(
+        target=lambda: started.wait(5) and pool.request_stop())
+    stopper.start()
+    pool.run()
+    stopper.join()
+
+    offsets = [commit.offset for commits in consumer.commits
+               for commit in commits.values()]
+    assert offsets == [1]
+
+
+def test_initializer_runs_on_every_worker_before_messages():
+    events = []
+    lock = threading.Lock()
+
+    def initializer():
+        with lock:
+            events.append(('init', threading.get_ident()))
+
+    def handler(message):
+        with lock:
+            events.append(('message', message.offset))
+
+    messages = [Message('topic', 0, offset, 'video') for offset in range(4)]
+    pool = WorkerPoolConsumer(ListConsumer(messages), handler, worker_count=3,
+                              poll_timeout_ms=10, initializer=initializer,
+                              ready=lambda: events.append(('ready', None)))
+    threading.Timer(0.5, pool.request_stop).start()
+    pool.run()
+
+    inits = [ident for kind, ident in events if kind == 'init']
+    assert len(set(inits)) == len(inits) == 3
+    assert [kind for kind, _ in events[:4]] == ['init'] * 3 + ['ready']
+    assert sorted(offset for kind, offset in events if kind == 'message') \
+        == [0, 1, 2, 3]
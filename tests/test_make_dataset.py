@@ -0,0 +1,31 @@
+import json
+
+import numpy as np
+from click.testing import CliRunner
+
+from src.data import make_dataset
+
+
+def test_main_writes_a_record_per_video(tmp_path, monkeypatch):
+    (tmp_path / 'videos').mkdir()
+    (tmp_path / 'videos' / 'a.mp4').write_bytes(b'')
+    output = tmp_path / 'records.jsonl'
+    model_version = make_dataset.ModelConsts.MODEL_VERSION
+
+    def process_video(video):
+        # numpy scalars as returned by the aggregated cluster info
+        people = [{'age': np.float32(30), 'duration': np.int64(4)}]
+        return {'video': video, 'model_version': model_version,
+                'has_faces': True, 'people': people}
+
+    monkeypatch.setattr(make_dataset, 'init_worker', lambda: None)
+    monkeypatch.setattr(make_dataset, 'process_video', process_video)
+    result = CliRunner().invoke(
+        make_dataset.main, [str(tmp_path / 'videos'), str(output)])
+    assert result.exit_code == 0, result.output
+
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert records == [{
+        'video': str(tmp_path / 'videos' / 'a.mp4'),
+        'model_version': model_version, 'has_faces': True,
+        'people': [{'age': 30.0, 'duration': 4}]}]
@@ -0,0 +1,140 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from src.utils import metrics
+from src.utils.s3_utils import VideoSpool
+
+MB = 2**20
+FILES = {
+    '/a.mp4': os.urandom(MB), '/b.mp4': os.urandom(MB),
+    '/big.mp4': os.urandom(3 * MB)}
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves FILES with range requests, the first response of every range is cut
+    in the middle
+    """
+    lock = threading.Lock()
+    served = set()
+    requests = []
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(FILES[self.path])))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        data = FILES[self.path]
+        start, end = 0, len(data) - 1
+        header = self.headers.get('Range')
+        if header:
+            first, last = header.split('=')[1].split('-')
+            start, end = int(first), int(last) if last else len(data) - 1
+        with self.lock:
+            self.requests.append((self.path, header))
+            cut = (self.path, end) not in self.served
+            self.served.add((self.path, end))
+        body = data[start:end + 1]
+        self.send_response(206 if header else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:len(body) // 2] if cut else body)
+        if cut:
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    RangeHandler.served, RangeHandler.requests = set(), []
+    server = Server(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_ranges_resume_after_interruption(server, tmp_path):
+    spool = VideoSpool(
+        str(tmp_path), 10 * MB, connections=3, part_size=MB, retries=2,
+        timeout=5)
+    with spool.local(server + '/big.mp4') as path:
+        assert read(path) == FILES['/big.mp4']
+    # every range was cut once and resumed from the last byte received, not
+    # from its start
+    resumed = [header for _, header in RangeHandler.requests
+               if header and int(header.split('=')[1].split('-')[0]) % MB != 0]
+    assert len(resumed) == 3
+    assert not [
+        name for name in os.listdir(str(tmp_path)) if name.endswith('.part')]
+
+
+def test_whole_file_resumes(server, tmp_path):
+    spool = VideoSpool(
+        str(tmp_path), 10 * MB, part_size=2 * MB, retries=2, timeout=5)
+    with spool.local(server + '/a.mp4') as path:
+        assert read(path) == FILES['/a.mp4']
+    headers = [header for _, header in RangeHandler.requests]
+    assert headers[0] is None and headers[1].endswith('-')
+    assert 0 < int(headers[1].split('=')[1][:-1]) <= MB // 2
+
+
+def test_prefetched_videos_are_not_evicted_until_released(server, tmp_path):
+    spool = VideoSpool(str(tmp_path), 3 * MB // 2, part_size=2 * MB, timeout=5)
+    a, b = server + '/a.mp4', server + '/b.mp4'
+    path_a = spool.prefetch(a).result()
+    # no room for b while a is held
+    assert spool.prefetch(b).result() == b
+    assert os.path.exists(path_a)
+    spool.release(a)
+    spool.release(b)
+    assert spool.downloads == {} and spool.pinned == {}
+    with spool.local(b) as path_b:
+        assert read(path_b) == FILES['/b.mp4']
+    assert not os.path.exists(path_a)
+
+
+def test_local_downloads_again_a_removed_video(server, tmp_path):
+    spool = VideoSpool(str(tmp_path), 10 * MB, part_size=2 * MB, timeout=5)
+    url = server + '/a.mp4'
+    os.remove(spool.prefetch(url).result())
+    with spool.local(url) as path:
+        assert read(path) == FILES['/a.mp4']
+    spool.release(url)
+    assert spool.downloads == {} and spool.pinned == {}
+
+
+def test_partial_downloads_are_only_removed_on_request(tmp_path):
+    part = tmp_path / 'video.mp4.123.part'
+    part.write_bytes(b'x')
+    spool = VideoSpool(str(tmp_path), MB)
+    assert part.exists()
+    spool.remove_partial_downloads()
+    assert not part.exists()
+
+
+def test_downloaded_bytes_are_counted_once_read(server, tmp_path):
+    spool = VideoSpool(str(tmp_path), 10 * MB, part_size=MB, timeout=5)
+    before = metrics.VIDEO_BYTES.values.get((), 0)
+    with spool.local(server + '/b.mp4'):
+        pass
+    with spool.local(server + '/b.mp4'):
+        pass  # spooled already, nothing is read
+    downloaded = metrics.VIDEO_BYTES.values.get((), 0) - before
+    assert downloaded == len(FILES['/b.mp4'])
@@ -0,0 +1,25 @@
+from src.utils import schedule_utils
+from src.utils.schedule_utils import VideoProbe, VideoScheduler
+
+
+def test_plan_reuses_the_probe_of_the_remote_url(monkeypatch):
+    probed = []
+
+    def probe_video(url, timeout=None):
+        probed.append(url)
+        return VideoProbe(60, 30, 1280, 720)
+
+    monkeypatch.setattr(schedule_utils, 'probe_video', probe_video)
+    scheduler = VideoScheduler(budget=1000)
+    cost = scheduler.cost('https://bucket/video.mp4', 1)
+    every_x_seconds, seek, estimate = scheduler.plan(
+        '/spool/video.mp4', 1, key='https://bucket/video.mp4')
+    assert probed == ['https://bucket/video.mp4']
+    assert (every_x_seconds, seek, estimate) == (1, False, cost)
+
+
+def test_unknown_videos_cost_the_budget(monkeypatch):
+    monkeypatch.setattr(
+        schedule_utils, 'probe_video', lambda url, timeout=None: None)
+    scheduler = VideoScheduler(budget=120)
+    assert scheduler.cost('https://bucket/video.mp4', 1) == 120
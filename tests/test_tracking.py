@@ -0,0 +1,86 @@
+import numpy as np
+
+from src.models.features import FeatureExtraction
+from src.models.tracking import FaceTracker
+
+
+class ListFaceAnalysis():
+    """
+    Returns the same faces, in the given order, for every merged frame
+    """
+
+    def __init__(self, bboxes):
+        self.bboxes = bboxes
+
+    def get(self, merged_frame):
+        return [{'bbox': np.array(bbox, dtype=np.float32), 'gender': 1,
+                 'age': 30} for bbox in self.bboxes]
+
+
+class IndexFaceEncoder():
+    @staticmethod
+    def face_encodings(merged_frame, known_face_locations):
+        return [np.full(128, location[3], dtype=np.float32)
+                for location in known_face_locations]
+
+
+def get_feature_extraction(bboxes, track_faces=True):
+    return FeatureExtraction(dual_detector=False, track_faces=track_faces,
+                             face_analysis=ListFaceAnalysis(bboxes),
+                             face_encoder=IndexFaceEncoder())
+
+
+def test_mosaic_weights_follow_detection_order():
+    # one row of two cells, detections are returned out of cell order
+    merged_frame = np.zeros((100, 200, 3), dtype=np.uint8)
+    bboxes = [(160, 60, 195, 95), (5, 5, 35, 35)]  # cell 1, then cell 0
+    cell_weights = np.array([[1, 5]])
+
+    for track_faces in (False, True):
+        feature_extraction = get_feature_extraction(bboxes, track_faces)
+        _, locations, _, _, weights, _ = feature_extraction.get_faces_raw_info(
+            [merged_frame], prescaled=True, weights=[cell_weights])
+        assert [location[3] for location in locations] == [160, 5]
+        assert weights == [5, 1]
+
+
+def test_tracked_weights_stay_with_their_faces():
+    # face A on cells 0 and 1, face B on cell 2, returned as B, then A of
+    # cell 1 and A of cell 0
+    merged_frame = np.zeros((100, 300, 3), dtype=np.uint8)
+    bboxes = [(260, 60, 295, 95), (105, 5, 135, 35), (5, 5, 35, 35)]
+    cell_weights = np.array([[1, 2, 4]])
+
+    feature_extraction = get_feature_extraction(bboxes)
+    _, locations, encodings, _, weights, counts = \
+        feature_extraction.get_faces_raw_info(
+            [merged_frame], prescaled=True, weights=[cell_weights])
+    # A on cell 1 continues the track of A on cell 0 and is not encoded
+    assert [location[3] for location in locations] == [260, 5]
+    assert len(encodings) == 2
+    assert weights == [4, 1 + 2]
+    assert counts == [1, 2]
+
+
+def test_mosaic_faces_keep_their_skin_tone_not_their_crop():
+    merged_frame = np.zeros((100, 200, 3), dtype=np.uint8)
+    # a skin coloured face (BGR) on cell 0, a black one on cell 1
+    merged_frame[5:35, 5:35] = (120, 160, 220)
+    bboxes = [(5, 5, 35, 35), (105, 5, 135, 35)]
+    feature_extraction = get_feature_extraction(bboxes, track_faces=False)
+    _, _, _, skin_tones, _, _ = feature_extraction.get_faces_raw_info(
+        [merged_frame], prescaled=True, weights=[np.array([[1, 1]])])
+    assert all(isinstance(skin_tone, float) for skin_tone in skin_tones)
+    assert not np.isnan(skin_tones[0])
+    assert np.isnan(skin_tones[1])
+
+
+def test_tracks_survive_max_gap_missed_frames():
+    tracker = FaceTracker(max_gap=1)
+    face = [(10, 40, 40, 10)]
+    assert tracker.update(0, face, [1]).tolist() == [True]
+    # frame 1 missed
+    assert tracker.update(2, face, [1]).tolist() == [False]
+    # frames 3 and 4 missed
+    assert tracker.update(5, face, [1]).tolist() == [True]
+    assert tracker.weights == [2, 1] and tracker.counts == [2, 1]